@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+import argparse
+import gc
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from mock_server import MockUnpacMeServer, MockUnpacMeState
+
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'unpac-me.py')
+
+
+def load_client():
+    spec = importlib.util.spec_from_file_location('unpac_me', CLIENT)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so functions of the client can be pickled for its process pools.
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+unpac_me = load_client()
+
+
+def make_state(args, **kwargs) -> MockUnpacMeState:
+    return MockUnpacMeState(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit=args.server_rate_limit,
+        **kwargs
+    )
+
+
+def make_api(server: MockUnpacMeServer, **kwargs):
+    api = unpac_me.UnpacMeApi('benchmark', 'UnpacMeClient/benchmark', **kwargs)
+    api.BASE_URL = server.base_url
+    return api
+
+
+def make_tasks(directory: str, count: int, size: int = 1024):
+    tasks = []
+    for i in range(count):
+        file_name = os.path.join(directory, F'sample-{i}')
+        with open(file_name, 'wb') as fp:
+            fp.write(os.urandom(size))
+        tasks.append(unpac_me.UploadTask(file_name, unpac_me.Sha256.from_file(file_name)))
+    return tasks
+
+
+class FixedPollingStrategy(unpac_me.PollingStrategy):
+    def next_interval(self, state) -> float:
+        return self.base_interval
+
+
+def serial_upload(api, tasks, poll_interval: float):
+    for task in tasks:
+        upload = api.upload(task.file_name, task.sha256)
+        while api.status(upload) != unpac_me.UnpacMeStatus.COMPLETE:
+            time.sleep(poll_interval)
+        api.results(upload)
+
+
+def concurrent_upload(api, tasks, strategy, concurrency: int):
+    for _ in unpac_me.SubmissionPoller(api, strategy, concurrency).run(tasks):
+        pass
+
+
+def bench_submit(args) -> dict:
+    durations = [random.uniform(args.max_duration / 4, args.max_duration) for _ in range(args.tasks)]
+    print(F'submit: {args.tasks} tasks, slowest {max(durations):.2f}s, sum {sum(durations):.2f}s')
+    poll_interval = args.poll_interval
+    metrics = {}
+    for name, run in (
+            ('serial', lambda api, tasks: serial_upload(api, tasks, poll_interval)),
+            ('fixed', lambda api, tasks: concurrent_upload(
+                api, tasks, FixedPollingStrategy(poll_interval), args.concurrency
+            )),
+            ('adaptive', lambda api, tasks: concurrent_upload(
+                api, tasks,
+                unpac_me.PollingStrategy(poll_interval, min_interval=poll_interval / 4, max_interval=poll_interval * 4),
+                args.concurrency
+            )),
+    ):
+        state = make_state(args, durations=durations)
+        with MockUnpacMeServer(state) as server, tempfile.TemporaryDirectory() as directory:
+            tasks = make_tasks(directory, args.tasks)
+            start = time.perf_counter()
+            run(make_api(server), tasks)
+            elapsed = time.perf_counter() - start
+        polls = state.request_counts.get('status', 0)
+        metrics[name] = {'seconds': elapsed, 'status_requests': polls}
+        print(F'  {name:<12} {elapsed:8.2f}s  {polls / args.tasks:6.1f} status requests per task')
+    return metrics
+
+
+def bench_upload(args) -> dict:
+    size = args.upload_size * 1024
+    with MockUnpacMeServer(make_state(args)) as server, tempfile.TemporaryDirectory() as directory:
+        tasks = make_tasks(directory, args.tasks, size)
+        poller = unpac_me.SubmissionPoller(make_api(server), unpac_me.PollingStrategy(), args.concurrency)
+        start = time.perf_counter()
+        for _ in poller.upload_all(tasks):
+            pass
+        elapsed = time.perf_counter() - start
+    metrics = {'files_per_second': args.tasks / elapsed, 'mib_per_second': args.tasks * size / elapsed / 1024 / 1024}
+    print(F'upload: {args.tasks} files of {args.upload_size} KiB  '
+          F'{metrics["files_per_second"]:8.1f} files/s  {metrics["mib_per_second"]:8.1f} MiB/s')
+    return metrics
+
+
+def bench_download(args) -> dict:
+    state = make_state(args, default_duration=0, children=args.children, child_size=args.child_size * 1024)
+    with MockUnpacMeServer(state) as server, tempfile.TemporaryDirectory() as directory:
+        api = make_api(server)
+        jobs = []
+        for _ in range(args.tasks):
+            upload = state.add_upload(os.urandom(1024))
+            results = api.results(unpac_me.UnpacMeUpload(upload.id, unpac_me.UnpacMeStatus.UNKNOWN, None, None))
+            jobs.extend(unpac_me.DownloadJob.from_results(results, directory))
+        pipeline = unpac_me.DownloadPipeline(api, args.concurrency)
+        for _ in pipeline.run(jobs):
+            pass
+    metrics = {'files': pipeline.downloaded, 'mib_per_second': pipeline.throughput / 1024 / 1024}
+    print(F'download: {pipeline.downloaded} files of {args.child_size} KiB  {metrics["mib_per_second"]:8.1f} MiB/s')
+    return metrics
+
+
+def bench_history(args) -> dict:
+    state = make_state(args)
+    state.seed(args.history)
+    metrics = {}
+    print(F'history: {args.history} submissions')
+    with MockUnpacMeServer(state) as server, tempfile.TemporaryDirectory() as directory:
+        api = make_api(server)
+        for page_size in (10, 100):
+            start = time.perf_counter()
+            count = sum(1 for _ in api.history(page_size))
+            elapsed = time.perf_counter() - start
+            metrics[F'page_size_{page_size}'] = elapsed
+            print(F'  page size {page_size:<4} {elapsed:8.2f}s  {count} submissions')
+
+        history_index = unpac_me.HistoryIndex(os.path.join(directory, 'history.sqlite'))
+        for name in ('initial sync', 'incremental sync'):
+            start = time.perf_counter()
+            count = history_index.sync(api)
+            elapsed = time.perf_counter() - start
+            metrics[name.replace(' ', '_')] = elapsed
+            print(F'  {name:<16} {elapsed:6.2f}s  {count} new submissions')
+    return metrics
+
+
+def bench_triage(args) -> dict:
+    size = args.triage_size * 1024
+    print(F'triage: {args.triage_files} files of {args.triage_size} KiB')
+    metrics = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(args.triage_files):
+            with open(os.path.join(directory, F'sample-{i}'), 'wb') as fp:
+                fp.write(os.urandom(size))
+        pattern = os.path.join(directory, 'sample-*')
+
+        start = time.perf_counter()
+        for file_name in sorted(os.listdir(directory)):
+            unpac_me.Sha256.from_file(os.path.join(directory, file_name))
+        metrics['serial'] = time.perf_counter() - start
+        print(F'  {"serial":<12} {metrics["serial"]:8.2f}s')
+
+        hash_cache = unpac_me.HashCache(os.path.join(directory, 'hashes.sqlite'))
+        for name in ('cold cache', 'warm cache'):
+            triage = unpac_me.FileTriage(hash_cache, args.processes)
+            start = time.perf_counter()
+            triage.run([pattern])
+            elapsed = time.perf_counter() - start
+            metrics[name.replace(' ', '_')] = elapsed
+            print(F'  {name:<12} {elapsed:8.2f}s  {triage.hashed} hashed, {triage.cached} from cache')
+        hash_cache.close()
+    return metrics
+
+
+def bench_startup(args) -> dict:
+    print(F'startup: {args.invocations} invocations')
+    metrics = {}
+    start = time.perf_counter()
+    for _ in range(args.invocations):
+        subprocess.run([sys.executable, CLIENT, '--help'], stdout=subprocess.DEVNULL, check=True)
+    metrics['help'] = (time.perf_counter() - start) / args.invocations
+    print(F'  {"--help":<12} {metrics["help"] * 1000:8.1f}ms per invocation')
+
+    with MockUnpacMeServer(make_state(args)) as server:
+        command = [sys.executable, CLIENT, '--api-key', 'benchmark', '--base-url', server.base_url, '--no-cache']
+        start = time.perf_counter()
+        for _ in range(args.invocations):
+            subprocess.run(command + ['quota'], stdout=subprocess.DEVNULL, check=True)
+        metrics['processes'] = (time.perf_counter() - start) / args.invocations
+        print(F'  {"processes":<12} {metrics["processes"] * 1000:8.1f}ms per quota command')
+
+        start = time.perf_counter()
+        subprocess.run(
+            command + ['batch'], input=b'quota\n' * args.invocations, stdout=subprocess.DEVNULL, check=True
+        )
+        metrics['batch'] = (time.perf_counter() - start) / args.invocations
+        print(F'  {"batch":<12} {metrics["batch"] * 1000:8.1f}ms per quota command')
+    return metrics
+
+
+class LegacySha256:
+    def __init__(self, sha256):
+        if len(sha256) != 64:
+            raise Exception(F'Invalid SHA256 hash: "{repr(sha256)}"')
+        self.hash = sha256
+
+
+class LegacyUnpackedSample:
+    def __init__(self, sha256, malware_names):
+        self.sha256 = sha256
+        self.malware_names = malware_names
+        self.autoit_original_file_name = None
+        self.autoit_sha256 = None
+
+    @staticmethod
+    def from_result(result):
+        return LegacyUnpackedSample(
+            LegacySha256(result['hashes']['sha256'] if 'hashes' in result.keys() else result['sha256']),
+            list(malware['name'] for malware in result['malware_id']) if 'malware_id' in result.keys() else [],
+        )
+
+
+class LegacyResults:
+    def __init__(self, raw_json):
+        self.raw_json = raw_json
+        self.sha256 = LegacySha256(raw_json['sha256'])
+        self.status = unpac_me.UnpacMeStatus.from_string(raw_json['status'])
+        self.samples = [LegacyUnpackedSample.from_result(result) for result in raw_json['results']]
+
+
+def make_raw_results(count: int, samples: int):
+    def sha256():
+        return hashlib.sha256(os.urandom(8)).hexdigest()
+
+    raw_results = []
+    for _ in range(count):
+        parent = sha256()
+        raw_results.append({
+            'sha256': parent,
+            'status': 'complete',
+            'results': [{'hashes': {'sha256': parent if i == 0 else sha256()}, 'malware_id': [{'name': 'win_test'}]}
+                        for i in range(samples)],
+        })
+    return raw_results
+
+
+def measure(factory, raw_results):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    objects = [factory(raw_json) for raw_json in raw_results]
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return objects, elapsed, size
+
+
+def bench_models(args) -> dict:
+    raw_results = make_raw_results(args.results, args.samples)
+    print(F'models: {args.results} results with {args.samples} samples each')
+
+    def materialized(raw_json):
+        results = unpac_me.UnpacMeResults(raw_json)
+        results.samples
+        return results
+
+    metrics = {}
+    for name, factory in (
+            ('legacy', LegacyResults),
+            ('compact', unpac_me.UnpacMeResults),
+            ('materialized', materialized),
+    ):
+        objects, elapsed, size = measure(factory, raw_results)
+        start = time.perf_counter()
+        for results in objects:
+            for sample in (results.iter_samples() if name == 'compact' else results.samples):
+                sample.sha256.hash
+        scan = time.perf_counter() - start
+        metrics[name] = {'build_seconds': elapsed, 'scan_seconds': scan, 'retained_bytes': size}
+        print(F'  {name:<12} build {elapsed * 1000:8.1f}ms  scan {scan * 1000:8.1f}ms  '
+              F'retained {size / 1024 / 1024:8.2f} MiB')
+    return metrics
+
+
+BENCHMARKS = {
+    'submit': bench_submit,
+    'upload': bench_upload,
+    'download': bench_download,
+    'history': bench_history,
+    'models': bench_models,
+    'triage': bench_triage,
+    'startup': bench_startup,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the client against a local mock server.')
+    parser.add_argument('benchmarks', nargs='*', help=F'Benchmarks to run: {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument('--tasks', type=int, default=10, help='Number of submissions.')
+    parser.add_argument('--poll-interval', type=float, default=.1)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--max-duration', type=float, default=1., help='Longest processing time of a submission.')
+    parser.add_argument('--upload-size', type=int, default=1024, help='Size of uploaded files in KiB.')
+    parser.add_argument('--children', type=int, default=5, help='Unpacked children per submission.')
+    parser.add_argument('--child-size', type=int, default=1024, help='Size of unpacked children in KiB.')
+    parser.add_argument('--history', type=int, default=2000, help='Number of submissions in the history.')
+    parser.add_argument('--triage-files', type=int, default=200, help='Number of files hashed by the triage.')
+    parser.add_argument('--triage-size', type=int, default=4096, help='Size of files hashed by the triage in KiB.')
+    parser.add_argument('--processes', type=int, help='Hashing processes of the triage (default: number of CPUs).')
+    parser.add_argument('--invocations', type=int, default=20, help='Number of client processes started.')
+    parser.add_argument('--results', type=int, default=10000)
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0., help='Seconds the mock server adds to every response.')
+    parser.add_argument('--error-rate', type=float, default=0., help='Fraction of requests answered with 502.')
+    parser.add_argument('--server-rate-limit', type=float, help='Requests per second before the server sends 429.')
+    parser.add_argument('--output', help='Write all measurements as JSON to this file.')
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(F'Unknown benchmark(s): {", ".join(sorted(unknown))}')
+
+    measurements = {name: BENCHMARKS[name](args) for name in (args.benchmarks or BENCHMARKS)}
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(measurements, fp, indent=4)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import threading
+import typing
+import time
+import urllib.parse
+import uuid
+
+# Fraction of a submission's processing time after which it enters the given status.
+DEFAULT_STAGES = [
+    (0., 'validating'),
+    (.05, 'queued'),
+    (.25, 'analyzing'),
+    (.35, 'unpack_pending'),
+    (.45, 'unpacking'),
+    (.7, 'unpacked'),
+    (.75, 'post_analysis'),
+]
+
+
+class MockUpload:
+    def __init__(self, id, sha256: str, created: float, duration: float, children: typing.List[str], fail: bool):
+        self.id = id
+        self.sha256 = sha256
+        self.created = created
+        self.duration = duration
+        self.children = children
+        self.fail = fail
+
+    def status(self, now: float, stages=DEFAULT_STAGES) -> str:
+        progress = (now - self.created) / self.duration if self.duration else 1.
+        if progress >= 1.:
+            return 'fail' if self.fail else 'complete'
+        current = stages[0][1]
+        for threshold, status in stages:
+            if progress >= threshold:
+                current = status
+        return current
+
+
+class MockUnpacMeState:
+    def __init__(
+            self,
+            durations=None,
+            default_duration: float = 1.,
+            stages=DEFAULT_STAGES,
+            latency: float = 0.,
+            error_rate: float = 0.,
+            fail_rate: float = 0.,
+            rate_limit: typing.Optional[float] = None,
+            children: int = 0,
+            child_size: int = 1024,
+            month_limit: int = 10000
+    ):
+        self.lock = threading.Lock()
+        self.uploads = {}
+        self.blobs = {}
+        self.durations = list(durations or [])
+        self.default_duration = default_duration
+        self.stages = stages
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fail_rate = fail_rate
+        self.rate_limit = rate_limit
+        self.children = children
+        self.child_size = child_size
+        self.month_limit = month_limit
+        self.request_counts = {}
+        self.bytes_sent = 0
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+
+    def count(self, endpoint: str):
+        with self.lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def throttled(self) -> bool:
+        if self.rate_limit is None:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1.:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            return self.window_requests > self.rate_limit
+
+    def add_upload(self, data: bytes, created: typing.Optional[float] = None) -> MockUpload:
+        children = [os.urandom(self.child_size) for _ in range(self.children)]
+        with self.lock:
+            duration = self.durations.pop(0) if self.durations else self.default_duration
+            upload = MockUpload(
+                str(uuid.uuid4()),
+                hashlib.sha256(data).hexdigest(),
+                time.time() if created is None else created,
+                duration,
+                [hashlib.sha256(child).hexdigest() for child in children],
+                random.random() < self.fail_rate
+            )
+            self.uploads[upload.id] = upload
+            self.blobs[upload.sha256] = data
+            for child_sha256, child in zip(upload.children, children):
+                self.blobs[child_sha256] = child
+        return upload
+
+    def seed(self, count: int):
+        now = time.time()
+        for i in range(count):
+            self.add_upload(os.urandom(32), now - count + i)
+
+
+class MockUnpacMeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, with Nagle's algorithm every keep-alive response would wait for the
+    # delayed ACK of the client.
+    disable_nagle_algorithm = True
+
+    @property
+    def state(self) -> MockUnpacMeState:
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status_code: int, j, headers: typing.Optional[typing.Dict[str, str]] = None):
+        body = json.dumps(j).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_blob(self, data: bytes):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        with self.state.lock:
+            self.state.bytes_sent += len(data)
+
+    def read_multipart_file(self) -> bytes:
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        boundary = re.search(r'boundary=(.+)', self.headers['Content-Type']).group(1).encode('ascii')
+        for part in body.split(b'--' + boundary):
+            headers, _, content = part.partition(b'\r\n\r\n')
+            if b'name="file"' in headers:
+                return content[:-2]
+        return b''
+
+    def discard_body(self):
+        if self.headers['Content-Length']:
+            self.rfile.read(int(self.headers['Content-Length']))
+
+    def before_request(self) -> bool:
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        if self.state.throttled():
+            self.state.count('throttled')
+            self.discard_body()
+            self.send_json(429, {'error': 'rate_limited', 'description': 'Too many requests'}, {'Retry-After': '1'})
+            return False
+        if self.state.error_rate and random.random() < self.state.error_rate:
+            self.state.count('error')
+            self.discard_body()
+            self.send_json(502, {'error': 'bad_gateway', 'description': 'Injected error'})
+            return False
+        return True
+
+    def do_POST(self):
+        if not self.before_request():
+            return
+        if self.path.endswith('/private/upload'):
+            self.state.count('upload')
+            upload = self.state.add_upload(self.read_multipart_file())
+            self.send_json(200, {'id': upload.id, 'success': True})
+        else:
+            self.discard_body()
+            self.send_json(404, {'error': 'not_found', 'description': self.path})
+
+    def send_history(self, query: typing.Dict):
+        self.state.count('history')
+        offset = int(query.get('cursor', ['0'])[0])
+        limit = int(query.get('limit', ['10'])[0])
+        now = time.time()
+        uploads = sorted(self.state.uploads.values(), key=lambda upload: upload.created, reverse=True)
+        page = uploads[offset:offset + limit]
+        if not page:
+            self.send_json(404, {'error': 'not_found', 'description': 'No more results'})
+            return
+        self.send_json(200, {
+            'cursor': str(offset + limit) if offset + limit < len(uploads) else None,
+            'results': [{
+                'id': upload.id,
+                'sha256': upload.sha256,
+                'status': upload.status(now, self.state.stages),
+                'created': int(upload.created),
+            } for upload in page],
+        })
+
+    def send_feed(self, size: int = 100):
+        self.state.count('feed')
+        now = time.time()
+        uploads = sorted(self.state.uploads.values(), key=lambda upload: upload.created, reverse=True)[:size]
+        self.send_json(200, {'results': [{
+            'id': upload.id,
+            'sha256': upload.sha256,
+            'status': upload.status(now, self.state.stages),
+            'created': int(upload.created),
+            'malwareid': [],
+            'children': len(upload.children),
+        } for upload in uploads]})
+
+    def send_quota(self):
+        self.state.count('quota')
+        self.send_json(200, {
+            'api_key': 'mock',
+            'total_submissions': len(self.state.uploads),
+            'month_submissions': len(self.state.uploads),
+            'month_limit': self.state.month_limit,
+            'roles': ['mock'],
+        })
+
+    def send_search(self, sha256: str):
+        self.state.count('search')
+        now = time.time()
+        results = [{
+            'submission_id': upload.id,
+            'sha256': upload.sha256,
+            'status': upload.status(now, self.state.stages),
+            'created': int(upload.created),
+            'children': upload.children,
+        } for upload in list(self.state.uploads.values()) if upload.sha256 == sha256]
+        if results:
+            self.send_json(200, {'results': results})
+        else:
+            self.send_json(404, {'error': 'not_found', 'description': 'Hash not found'})
+
+    def send_download(self, sha256: str):
+        self.state.count('download')
+        data = self.state.blobs.get(sha256)
+        if data is None:
+            self.send_json(404, {'error': 'not_found', 'description': 'Unknown hash'})
+        else:
+            self.send_blob(data)
+
+    def send_submission(self, endpoint: str, upload_id: str):
+        self.state.count(endpoint)
+        upload = self.state.uploads.get(upload_id)
+        if upload is None:
+            self.send_json(404, {'error': 'not_found', 'description': F'Unknown submission "{upload_id}"'})
+            return
+
+        status = upload.status(time.time(), self.state.stages)
+        if endpoint == 'status':
+            self.send_json(200, {'id': upload.id, 'status': status})
+            return
+        results = [{'hashes': {'sha256': upload.sha256}, 'malware_id': []}]
+        if status in ('post_analysis', 'complete', 'fail'):
+            results.extend(
+                {'hashes': {'sha256': child}, 'malware_id': [{'name': 'win_mock'}]} for child in upload.children
+            )
+        self.send_json(200, {'id': upload.id, 'sha256': upload.sha256, 'status': status, 'results': results})
+
+    def do_GET(self):
+        if not self.before_request():
+            return
+        path = urllib.parse.urlparse(self.path).path
+        submission = re.search(r'/public/(status|results)/([^/]+)$', path)
+        if path.endswith('/private/history'):
+            self.send_history(urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query))
+        elif path.endswith('/public/feed'):
+            self.send_feed()
+        elif path.endswith('/private/user/access'):
+            self.send_quota()
+        elif re.search(r'/private/search/hash/[0-9a-f]{64}$', path):
+            self.send_search(path[-64:])
+        elif re.search(r'/private/download/[0-9a-f]{64}$', path):
+            self.send_download(path[-64:])
+        elif submission:
+            self.send_submission(*submission.groups())
+        else:
+            self.send_json(404, {'error': 'not_found', 'description': self.path})
+
+
+class MockUnpacMeServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, state: MockUnpacMeState, host: str = '127.0.0.1', port: int = 0):
+        super(MockUnpacMeServer, self).__init__((host, port), MockUnpacMeHandler)
+        self.state = state
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        return F'http://{self.server_address[0]}:{self.server_address[1]}/api/v1'
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the unpac.me API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--duration', type=float, default=5., help='Seconds until a submission is complete.')
+    parser.add_argument('--latency', type=float, default=0., help='Seconds added to every response.')
+    parser.add_argument('--error-rate', type=float, default=0., help='Fraction of requests answered with 502.')
+    parser.add_argument('--fail-rate', type=float, default=0., help='Fraction of submissions ending in "fail".')
+    parser.add_argument('--rate-limit', type=float, help='Requests per second before answering with 429.')
+    parser.add_argument('--children', type=int, default=0, help='Number of unpacked children per submission.')
+    parser.add_argument('--child-size', type=int, default=1024, help='Size of every unpacked child in bytes.')
+    parser.add_argument('--seed', type=int, default=0, help='Number of submissions to pre-populate the history with.')
+    args = parser.parse_args()
+
+    state = MockUnpacMeState(
+        default_duration=args.duration,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        fail_rate=args.fail_rate,
+        rate_limit=args.rate_limit,
+        children=args.children,
+        child_size=args.child_size,
+    )
+    state.seed(args.seed)
+    server = MockUnpacMeServer(state, args.host, args.port)
+    print(F'Serving on {server.base_url}')
+    server.serve_forever()
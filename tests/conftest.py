@@ -0,0 +1,65 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mock_server import MockUnpacMeServer, MockUnpacMeState  # noqa: E402
+
+
+def load_client():
+    spec = importlib.util.spec_from_file_location('unpac_me', os.path.join(ROOT, 'unpac-me.py'))
+    module = importlib.util.module_from_spec(spec)
+    # Registered so functions of the client can be pickled for its process pools.
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+unpac_me = load_client()
+
+
+@pytest.fixture
+def client():
+    return unpac_me
+
+
+@pytest.fixture
+def state():
+    return MockUnpacMeState(default_duration=.3)
+
+
+@pytest.fixture
+def server(state):
+    with MockUnpacMeServer(state) as server:
+        yield server
+
+
+@pytest.fixture
+def make_api(server):
+    def make_api(**kwargs):
+        api = unpac_me.UnpacMeApi('test', 'UnpacMeClient/test', **kwargs)
+        api.BASE_URL = server.base_url
+        return api
+    return make_api
+
+
+@pytest.fixture
+def api(make_api):
+    return make_api()
+
+
+@pytest.fixture
+def make_tasks(tmp_path):
+    def make_tasks(count: int, size: int = 1024, directory: str = str(tmp_path)):
+        tasks = []
+        for i in range(count):
+            file_name = os.path.join(directory, F'sample-{i}')
+            with open(file_name, 'wb') as fp:
+                fp.write(os.urandom(size))
+            tasks.append(unpac_me.UploadTask(file_name, unpac_me.Sha256.from_file(file_name)))
+        return tasks
+    return make_tasks
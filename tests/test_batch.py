@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+import conftest
+
+
+def run_batch(server, lines, *options):
+    return subprocess.run(
+        [sys.executable, os.path.join(conftest.ROOT, 'unpac-me.py'), '--api-key', 'test', '--base-url',
+         server.base_url, '--no-cache', *options, 'batch', '--separator', 'END'],
+        input=''.join(line + '\n' for line in lines), capture_output=True, text=True, timeout=60
+    )
+
+
+def test_batch_runs_every_line_in_one_process(server, state):
+    process = run_batch(server, ['quota', '# comment', '', 'quota'])
+    assert process.returncode == 0
+    assert process.stdout.count('END\n') == 2
+    assert state.request_counts['quota'] == 2
+
+
+def test_batch_rejects_global_options_per_line(server, state):
+    process = run_batch(server, ['--timeout 1 quota', '--no-cache quota', 'batch', 'quota'], '--timeout', '30')
+    assert process.returncode == 0
+    assert process.stdout.count('END\n') == 4
+    assert 'Global options must be given before "batch", not per line: --timeout' in process.stdout
+    assert 'not per line: --no-cache' in process.stdout
+    assert 'Expected a command other than batch' in process.stdout
+    assert state.request_counts['quota'] == 1
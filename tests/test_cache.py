@@ -0,0 +1,38 @@
+import time
+
+
+def test_completed_results_are_served_from_the_cache(client, make_api, state, tmp_path):
+    upload = state.add_upload(b'sample', time.time() - 1)
+    for _ in range(2):
+        api = make_api(cache=client.ResultCache(str(tmp_path / 'cache')))
+        results = api.results(client.UnpacMeUpload(upload.id, client.UnpacMeStatus.UNKNOWN, None, None))
+        assert results.status == client.UnpacMeStatus.COMPLETE
+        assert api.status(client.UnpacMeUpload(upload.id, None, None, None)) == client.UnpacMeStatus.COMPLETE
+    assert state.request_counts['results'] == 1
+    assert 'status' not in state.request_counts
+
+
+def test_unfinished_results_are_not_cached(client, make_api, state, tmp_path):
+    upload = state.add_upload(b'sample')
+    api = make_api(cache=client.ResultCache(str(tmp_path / 'cache')))
+    for _ in range(2):
+        api.results(client.UnpacMeUpload(upload.id, client.UnpacMeStatus.UNKNOWN, None, None))
+    assert state.request_counts['results'] == 2
+
+
+def test_eviction_removes_oldest_entries_below_the_limit(client, tmp_path):
+    cache = client.ResultCache(str(tmp_path / 'cache'), max_size=1000)
+    for i in range(30):
+        cache.put_results(str(i), {'padding': 'x' * 80})
+    stored, = cache.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+    assert cache.total_size == stored <= 1000
+    assert cache.get_results('0') is None
+    assert cache.get_results('29') == {'padding': 'x' * 80}
+
+
+def test_replacing_an_entry_does_not_count_it_twice(client, tmp_path):
+    cache = client.ResultCache(str(tmp_path / 'cache'), max_size=1000)
+    for _ in range(30):
+        cache.put_results('same', {'padding': 'x' * 80})
+    assert cache.total_size == len('{"padding":"' + 'x' * 80 + '"}')
+    assert client.ResultCache(str(tmp_path / 'cache')).total_size == cache.total_size
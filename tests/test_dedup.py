@@ -0,0 +1,29 @@
+import mock_server
+
+
+def test_known_hashes_are_not_uploaded(client, api, state, make_tasks):
+    known, new = make_tasks(2)
+    with open(known.file_name, 'rb') as fp:
+        state.add_upload(fp.read(), created=0)
+    new_tasks, known_tasks = client.Deduplicator(api).lookup([known, new])
+    assert [task.file_name for task in new_tasks] == [new.file_name]
+    assert [task.file_name for task in known_tasks] == [known.file_name]
+
+
+def test_empty_search_results_are_not_cached(client, make_api, monkeypatch, make_tasks, tmp_path):
+    monkeypatch.setattr(
+        mock_server.MockUnpacMeHandler, 'send_search', lambda handler, sha256: handler.send_json(200, {'results': []})
+    )
+    task, = make_tasks(1)
+    for _ in range(2):
+        cache = client.ResultCache(str(tmp_path / 'cache'))
+        deduplicator = client.Deduplicator(make_api(cache=cache), known_hashes=cache.known_hashes())
+        assert not deduplicator.is_known(task.sha256)
+        cache.close()
+
+
+def test_empty_search_results_cached_earlier_are_not_known(client, tmp_path):
+    cache = client.ResultCache(str(tmp_path / 'cache'))
+    sha256 = client.Sha256.from_data(b'sample')
+    cache.put_search(sha256, [])
+    assert sha256.hash not in cache.known_hashes()
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+
+def test_download_to_file_writes_the_verified_content(client, api, state, tmp_path):
+    data = os.urandom(200000)
+    state.blobs[client.Sha256.from_data(data).hash] = data
+    target = str(tmp_path / 'sample')
+    assert api.download_to_file(client.Sha256.from_data(data), target, chunk_size=4096) == len(data)
+    with open(target, 'rb') as fp:
+        assert fp.read() == data
+    assert os.listdir(str(tmp_path)) == ['sample']
+
+
+def test_download_with_hash_mismatch_leaves_no_file_behind(client, api, state, tmp_path):
+    expected = client.Sha256.from_data(b'expected')
+    state.blobs[expected.hash] = b'something else'
+    target = str(tmp_path / 'sample')
+    with pytest.raises(client.HashMismatchApiException):
+        api.download_to_file(expected, target)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_download_with_hash_mismatch_is_not_cached(client, make_api, state, tmp_path):
+    expected = client.Sha256.from_data(b'expected')
+    state.blobs[expected.hash] = b'something else'
+    cache = client.ResultCache(str(tmp_path / 'cache'))
+    with pytest.raises(client.HashMismatchApiException):
+        make_api(cache=cache).download_to_file(expected, str(tmp_path / 'sample'))
+    assert cache.get_blob(expected) is None
@@ -0,0 +1,75 @@
+import datetime
+import gzip
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def make_uploads(client, state):
+    state.children = 2
+
+    def make_uploads(count: int, duration: float = 0.):
+        uploads = []
+        for _ in range(count):
+            mock = state.add_upload(os.urandom(64))
+            mock.duration = duration
+            uploads.append(client.UnpacMeUpload(
+                mock.id, client.UnpacMeStatus.UNKNOWN, datetime.datetime.utcfromtimestamp(mock.created), None
+            ))
+        return uploads
+    return make_uploads
+
+
+def read_rows(file_name: str):
+    with gzip.open(file_name, 'rt') as fp:
+        return [json.loads(line) for line in fp]
+
+
+def test_export_writes_one_row_per_sample(client, api, make_uploads, tmp_path):
+    uploads = make_uploads(2)
+    exporter = client.ResultsExporter(api, str(tmp_path))
+    file_name = exporter.run(uploads)
+    assert file_name.endswith('.jsonl.gz')
+    rows = read_rows(file_name)
+    assert len(rows) == exporter.rows == 6
+    assert {row['upload_id'] for row in rows} == {upload.id for upload in uploads}
+    assert all(row['status'] == 'complete' for row in rows)
+    children = [row for row in rows if row['malware_names']]
+    assert len(children) == 4
+    assert all(row['parent_sha256'] != row['sha256'] for row in children)
+    exporter.close()
+
+
+def test_export_only_appends_new_submissions(client, api, make_uploads, tmp_path):
+    uploads = make_uploads(2)
+    exporter = client.ResultsExporter(api, str(tmp_path))
+    first = exporter.run(uploads)
+    assert exporter.run(uploads) is None
+
+    uploads.extend(make_uploads(1))
+    second = exporter.run(uploads)
+    assert second != first
+    assert {row['upload_id'] for row in read_rows(second)} == {uploads[-1].id}
+    assert exporter.exported == 3
+    exporter.close()
+
+    reopened = client.ResultsExporter(api, str(tmp_path))
+    assert reopened.run(uploads) is None
+    reopened.close()
+    assert sorted(name for name in os.listdir(str(tmp_path)) if name.startswith('samples-')) == \
+        sorted([os.path.basename(first), os.path.basename(second)])
+
+
+def test_export_retries_unfinished_submissions(client, api, make_uploads, state, tmp_path):
+    unfinished, = make_uploads(1, duration=1000.)
+    exporter = client.ResultsExporter(api, str(tmp_path))
+    assert exporter.run([unfinished]) is None
+    assert exporter.pending == 1
+    assert [name for name in os.listdir(str(tmp_path)) if name.endswith('.part')] == []
+
+    state.uploads[unfinished.id].duration = 0.
+    file_name = exporter.run([unfinished])
+    assert {row['upload_id'] for row in read_rows(file_name)} == {unfinished.id}
+    exporter.close()
@@ -0,0 +1,65 @@
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture
+def add_upload(state):
+    def add_upload(age: float = 0., duration: float = 0.):
+        upload = state.add_upload(os.urandom(32), time.time() - age)
+        upload.duration = duration
+        return upload
+    return add_upload
+
+
+def completed(entry) -> bool:
+    return entry.upload.status.name == 'COMPLETE'
+
+
+def test_follower_emits_every_entry_once(client, api, add_upload):
+    first = [add_upload(age) for age in (30, 20, 10)]
+    follower = client.FeedFollower(api, interval=0)
+    assert [entry.upload.id for entry in follower.poll()] == [upload.id for upload in first]
+    assert follower.poll() == []
+
+    latest = add_upload()
+    assert [entry.upload.id for entry in follower.poll()] == [latest.id]
+
+
+def test_follower_skips_entries_older_than_the_lookback(client, api, add_upload):
+    follower = client.FeedFollower(api, interval=0)
+    follower.poll()
+    add_upload()
+    follower.poll()
+    stale = add_upload(age=7200)
+    assert stale.id not in [entry.upload.id for entry in follower.poll()]
+
+
+def test_follower_emits_slow_submissions_once_they_match(client, api, add_upload, state):
+    slow = add_upload(age=7200, duration=10000)
+    add_upload()
+    follower = client.FeedFollower(api, interval=0)
+    assert slow.id not in [entry.upload.id for entry in follower.poll(completed)]
+    assert follower.poll(completed) == []
+
+    slow.duration = 0.
+    assert [entry.upload.id for entry in follower.poll(completed)] == [slow.id]
+    assert follower.poll(completed) == []
+
+
+def test_follower_keeps_polling_after_errors(client, api, add_upload, state, monkeypatch):
+    upload = add_upload()
+    calls = []
+    public_feed = api.public_feed
+
+    def flaky_feed():
+        calls.append(None)
+        if len(calls) == 1:
+            raise client.ApiException('Api-Exception: unavailable')
+        return public_feed()
+
+    monkeypatch.setattr(api, 'public_feed', flaky_feed)
+    entries = list(client.FeedFollower(api, interval=0).follow(max_polls=3))
+    assert [entry.upload.id for entry in entries] == [upload.id]
+    assert len(calls) == 3
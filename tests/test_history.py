@@ -0,0 +1,68 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import conftest
+import mock_server
+
+
+def test_history_pages_until_last_page(api, state):
+    state.seed(25)
+    assert len(list(api.history(page_size=7))) == 25
+    assert state.request_counts['history'] == 4
+
+
+def test_async_history_pages_until_last_page(client, server, state):
+    pytest.importorskip('aiohttp')
+    state.seed(25)
+
+    async def collect():
+        api = client.AsyncUnpacMeApi('test', 'UnpacMeClient/test')
+        api.BASE_URL = server.base_url
+        try:
+            return [upload async for upload in api.history(page_size=7)]
+        finally:
+            await api.close()
+
+    assert len(asyncio.run(asyncio.wait_for(collect(), 10))) == 25
+    assert state.request_counts['history'] == 4
+
+
+def test_sync_refreshes_older_unfinished_uploads_without_walking_the_history(client, api, state, tmp_path):
+    state.durations = [11., 0., 0.]
+    now = time.time()
+    older = state.add_upload(b'older', now - 10)
+    state.add_upload(b'middle', now - 6)
+    state.add_upload(b'newer', now - 5)
+    index = client.HistoryIndex(str(tmp_path / 'history.sqlite'))
+    assert index.sync(api, page_size=1) == 3
+    assert {upload.id: upload.status for upload in index.query()}[older.id] == client.UnpacMeStatus.POST_ANALYSIS
+    time.sleep(1.5)
+    history_requests, status_requests = state.request_counts['history'], state.request_counts['status']
+    index.sync(api, page_size=1)
+    assert all(upload.status == client.UnpacMeStatus.COMPLETE for upload in index.query())
+    assert state.request_counts['history'] - history_requests == 1
+    assert state.request_counts['status'] - status_requests == 1
+
+
+def test_unknown_statuses_are_stored_as_unknown(client, api, state, tmp_path, monkeypatch):
+    monkeypatch.setattr(mock_server.MockUpload, 'status', lambda upload, now, stages: 'reticulating')
+    upload = state.add_upload(b'sample')
+    index = client.HistoryIndex(str(tmp_path / 'history.sqlite'))
+    index.sync(api)
+    assert [stored.status for stored in index.query()] == [client.UnpacMeStatus.UNKNOWN]
+    assert api.status(client.UnpacMeUpload(upload.id, None, None, None)) == client.UnpacMeStatus.UNKNOWN
+
+
+def test_history_rejects_unknown_status_filter():
+    process = subprocess.run(
+        [sys.executable, os.path.join(conftest.ROOT, 'unpac-me.py'), '--api-key', 'test', 'history', '--local',
+         '--status', 'complte'],
+        capture_output=True, text=True
+    )
+    assert process.returncode == 2
+    assert 'unknown status "complte"' in process.stderr
@@ -0,0 +1,71 @@
+import datetime
+import os
+
+import pytest
+
+import mock_server
+
+
+@pytest.fixture
+def metrics_api(client, make_api):
+    return make_api(metrics=client.ApiMetrics())
+
+
+def make_upload(client, state):
+    mock = state.add_upload(os.urandom(32))
+    return client.UnpacMeUpload(mock.id, client.UnpacMeStatus.UNKNOWN, datetime.datetime.utcnow(), None)
+
+
+def test_endpoint_names_replace_ids_and_hashes(client):
+    assert client.ApiMetrics.endpoint_name(
+        'https://api.unpac.me/api/v1/public/status/0dfd97cd-df01-4ea6-9ca5-7597cf03dbbb'
+    ) == '/public/status/{id}'
+    assert client.ApiMetrics.endpoint_name(
+        'https://api.unpac.me/api/v1/private/download/' + '0' * 64
+    ) == '/private/download/{sha256}'
+
+
+def test_metrics_count_requests_per_endpoint_and_status(client, metrics_api, state):
+    upload = make_upload(client, state)
+    metrics_api.get_quota()
+    for _ in range(3):
+        metrics_api.status(upload)
+    with pytest.raises(client.ApiException):
+        metrics_api.status(client.UnpacMeUpload(
+            '00000000-0000-0000-0000-000000000000', client.UnpacMeStatus.UNKNOWN, datetime.datetime.utcnow(), None
+        ))
+
+    metrics = metrics_api.metrics
+    assert metrics.requests[('/private/user/access', 200)] == 1
+    assert metrics.requests[('/public/status/{id}', 200)] == 3
+    assert metrics.requests[('/public/status/{id}', 404)] == 1
+    assert metrics.polls[upload.id] == 3
+    assert metrics.bytes_received > 0
+
+    summary = metrics.summary().splitlines()
+    status_line, = [line for line in summary if line.startswith('/public/status/{id}')]
+    assert status_line.split()[1:4] == ['4', '1', '0']
+    assert 'Polled 2 submission(s) 4 time(s), at most 3 time(s) each' in summary
+
+    prometheus = metrics.prometheus()
+    assert 'unpacme_requests_total{endpoint="/public/status/{id}",code="200"} 3\n' in prometheus
+    assert 'unpacme_request_duration_seconds_count{endpoint="/public/status/{id}"} 4\n' in prometheus
+    assert 'unpacme_polled_submissions 2\n' in prometheus
+
+
+def test_metrics_count_retries_of_the_final_response(client, metrics_api, state, monkeypatch):
+    upload = make_upload(client, state)
+    send_submission = mock_server.MockUnpacMeHandler.send_submission
+    failures = [502]
+
+    def flaky_submission(self, endpoint, upload_id):
+        if failures:
+            self.send_json(failures.pop(), {'error': 'bad_gateway', 'description': 'Injected error'})
+            return
+        send_submission(self, endpoint, upload_id)
+
+    monkeypatch.setattr(mock_server.MockUnpacMeHandler, 'send_submission', flaky_submission)
+    metrics_api.status(upload)
+    assert metrics_api.metrics.requests[('/public/status/{id}', 200)] == 1
+    assert metrics_api.metrics.retries['/public/status/{id}'] == 1
+    assert 'unpacme_retries_total{endpoint="/public/status/{id}"} 1\n' in metrics_api.metrics.prometheus()
@@ -0,0 +1,20 @@
+import time
+
+
+def test_submission_progresses_to_complete(client, api, state):
+    state.children = 2
+    upload = api.upload(b'sample')
+    assert not api.status(upload).terminal
+    time.sleep(.4)
+    assert api.status(upload) == client.UnpacMeStatus.COMPLETE
+    results = api.results(upload)
+    assert len(list(results.iter_samples())) == 3
+    assert api.get_quota().month_submissions == 1
+
+
+def test_rate_limit_answers_with_retry_after(make_api, state):
+    state.rate_limit = 1
+    api = make_api(retries=0)
+    responses = [api.session.get(F'{api.BASE_URL}/private/user/access') for _ in range(3)]
+    assert [response.status_code for response in responses] == [200, 429, 429]
+    assert responses[-1].headers['Retry-After'] == '1'
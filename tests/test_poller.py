@@ -0,0 +1,68 @@
+import os
+import queue
+
+import pytest
+
+import mock_server
+
+
+@pytest.fixture
+def make_poller(client):
+    def make_poller(api, **kwargs):
+        poller = client.SubmissionPoller(api, client.PollingStrategy(.05, min_interval=.01, max_interval=.1), **kwargs)
+        poller.UPLOAD_RETRY_INTERVAL = .05
+        return poller
+    return make_poller
+
+
+def test_poller_keeps_poll_counts_and_latency_of_finished_submissions(client, api, make_poller, make_tasks):
+    poller = make_poller(api)
+    finished = list(poller.run(make_tasks(3)))
+    assert all(upload.status == client.UnpacMeStatus.COMPLETE for _, upload, _ in finished)
+    assert poller.stats == {}
+    assert sorted(state.upload.id for state in poller.completed) == sorted(upload.id for _, upload, _ in finished)
+    assert all(state.polls >= 2 and state.latency > .2 for state in poller.completed)
+
+
+def test_poller_with_queue_survives_failing_requests(client, make_api, make_poller, make_tasks, state):
+    state.error_rate = .3
+    poller = make_poller(make_api(retries=0))
+    tasks = make_tasks(10)
+    incoming = queue.Queue()
+    for task in tasks + [None]:
+        incoming.put(task)
+    finished = list(poller.run([], incoming=incoming))
+    assert sorted(task.file_name for task, _, _ in finished) == sorted(task.file_name for task in tasks)
+    assert all(upload.status == client.UnpacMeStatus.COMPLETE for _, upload, _ in finished)
+    assert state.request_counts['error'] > 0
+    assert poller.stats == {}
+
+
+def test_poller_without_queue_raises_on_failing_requests(client, make_api, make_poller, make_tasks, state):
+    state.error_rate = 1.
+    with pytest.raises(client.ApiException):
+        list(make_poller(make_api(retries=0)).run(make_tasks(1)))
+
+
+def test_poller_skips_files_that_cannot_be_read(client, api, make_poller, make_tasks):
+    missing, present = make_tasks(2)
+    os.remove(missing.file_name)
+    finished = list(make_poller(api).run([missing, present]))
+    assert [(task.file_name, upload.status) for task, upload, _ in finished] == [
+        (present.file_name, client.UnpacMeStatus.COMPLETE)
+    ]
+
+
+def test_poller_with_queue_gives_up_on_rejected_uploads(client, api, make_poller, make_tasks, state, monkeypatch):
+    def reject(handler):
+        handler.state.count('upload')
+        handler.discard_body()
+        handler.send_json(400, {'error': 'invalid_file', 'description': 'Not a PE file'})
+
+    monkeypatch.setattr(mock_server.MockUnpacMeHandler, 'do_POST', reject)
+    task, = make_tasks(1)
+    incoming = queue.Queue()
+    incoming.put(None)
+    finished = list(make_poller(api).run([task], incoming=incoming))
+    assert [(upload.id, upload.status) for _, upload, _ in finished] == [(None, client.UnpacMeStatus.FAIL)]
+    assert state.request_counts['upload'] == 1
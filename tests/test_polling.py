@@ -0,0 +1,19 @@
+import datetime
+
+
+def poll_state(client, status, polls_in_status: int):
+    state = client.PollState(client.UnpacMeUpload('id', status, datetime.datetime.now(), None), 0.)
+    state.polls_in_status = polls_in_status
+    return state
+
+
+def test_waiting_stages_back_off_up_to_the_maximum(client):
+    strategy = client.PollingStrategy(10, min_interval=1, max_interval=60, jitter=0)
+    intervals = [strategy.next_interval(poll_state(client, client.UnpacMeStatus.QUEUED, polls)) for polls in (1, 2, 9)]
+    assert intervals == [30, 45, 60]
+
+
+def test_stages_close_to_completion_keep_a_short_interval(client):
+    strategy = client.PollingStrategy(10, min_interval=1, max_interval=60, jitter=0)
+    for polls in (1, 5, 50):
+        assert strategy.next_interval(poll_state(client, client.UnpacMeStatus.POST_ANALYSIS, polls)) == 5
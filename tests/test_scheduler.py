@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def make_scheduler(client, api, tmp_path):
+    def make_scheduler(share: float = 1.):
+        return client.QuotaScheduler(
+            client.QuotaTracker(api, str(tmp_path / 'quota.json')),
+            client.SubmissionBacklog(str(tmp_path / 'backlog.sqlite')),
+            share
+        )
+    return make_scheduler
+
+
+def test_scheduler_drops_deleted_and_modified_files(make_scheduler, make_tasks):
+    deleted, modified, kept = make_tasks(3)
+    scheduler = make_scheduler()
+    scheduler.backlog.add([deleted, modified, kept])
+    os.remove(deleted.file_name)
+    with open(modified.file_name, 'ab') as fp:
+        fp.write(b'appended')
+    assert [task.file_name for task in scheduler.schedule()] == [kept.file_name]
+    assert len(scheduler.backlog) == 1
+
+
+def test_scheduler_submits_within_share_of_remaining_quota(make_scheduler, make_tasks, state):
+    state.month_limit = 20
+    scheduler = make_scheduler(.2)
+    assert len(scheduler.schedule(make_tasks(10))) == 4
+    assert len(scheduler.backlog) == 10
+
+
+def test_scheduler_drains_last_submissions_of_the_month(make_scheduler, make_tasks, state):
+    state.month_limit = 4
+    scheduler = make_scheduler(.2)
+    scheduled = scheduler.schedule(make_tasks(3))
+    assert len(scheduled) == 1
+    scheduler.submitted(scheduled[0])
+    assert scheduler.tracker.quota().remaining == 3
+    assert scheduler.schedule() == []
+    assert len(make_scheduler(.2).schedule()) == 1
+
+
+def test_scheduler_stops_when_quota_is_used_up(make_scheduler, make_tasks, state):
+    state.month_limit = 1
+    state.add_upload(b'used')
+    assert make_scheduler(.2).schedule(make_tasks(2)) == []
@@ -0,0 +1,68 @@
+import threading
+import time
+import types
+
+import pytest
+
+
+class GraphApi:
+    def __init__(self, client, graph, slow=()):
+        self.client = client
+        self.hashes = {name: client.Sha256.from_data(name.encode()) for name in graph}
+        self.names = {sha256: name for name, sha256 in self.hashes.items()}
+        self.graph = graph
+        self.slow = slow
+        self.lock = threading.Lock()
+        self.lookups = []
+
+    def search_hash(self, sha256):
+        name = self.names[sha256]
+        with self.lock:
+            self.lookups.append(name)
+        if name in self.slow:
+            time.sleep(.2)
+        if not self.graph[name] and name.startswith('unknown'):
+            raise self.client.HashNotFoundApiException(name)
+        yield types.SimpleNamespace(
+            upload=types.SimpleNamespace(id=F'upload-{name}'),
+            children=[self.hashes[child] for child in self.graph[name]]
+        )
+
+
+@pytest.fixture
+def make_resolver(client):
+    def make_resolver(graph, max_depth=None, slow=()):
+        api = GraphApi(client, graph, slow)
+        return api, client.UnpackTreeResolver(api, max_depth=max_depth)
+    return make_resolver
+
+
+def test_depth_is_the_shortest_path_regardless_of_lookup_order(make_resolver):
+    api, resolver = make_resolver(
+        {'r1': ['c'], 'r2': ['d'], 'c': ['d'], 'd': ['e'], 'e': []}, max_depth=2, slow=('r2',)
+    )
+    nodes = resolver.resolve([api.hashes['r1'], api.hashes['r2']])
+    assert {api.names[sha256]: node.depth for sha256, node in nodes.items()} == {
+        'r1': 0, 'r2': 0, 'c': 1, 'd': 1, 'e': 2
+    }
+
+
+def test_shared_children_and_cycles_are_looked_up_once(make_resolver):
+    api, resolver = make_resolver({'root': ['a', 'b'], 'a': ['shared'], 'b': ['shared'], 'shared': ['root']})
+    nodes = resolver.resolve([api.hashes['root']])
+    assert sorted(api.lookups) == ['a', 'b', 'root', 'shared']
+    assert resolver.lookups == 4
+    assert nodes[api.hashes['shared']].children == [api.hashes['root']]
+
+
+def test_children_beyond_max_depth_are_not_looked_up(make_resolver):
+    api, resolver = make_resolver({'root': ['a'], 'a': ['b'], 'b': []}, max_depth=1)
+    resolver.resolve([api.hashes['root']])
+    assert sorted(api.lookups) == ['a', 'root']
+
+
+def test_hashes_without_submissions_are_leaves(make_resolver):
+    api, resolver = make_resolver({'root': ['unknown'], 'unknown': []})
+    nodes = resolver.resolve([api.hashes['root']])
+    assert nodes[api.hashes['unknown']].submissions == []
+    assert nodes[api.hashes['root']].submissions == ['upload-root']
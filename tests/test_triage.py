@@ -0,0 +1,36 @@
+import os
+import shutil
+
+
+def test_triage_keeps_the_first_of_files_with_the_same_content(client, make_tasks, tmp_path):
+    first, second = make_tasks(2)
+    copy = str(tmp_path / 'copy')
+    shutil.copy(first.file_name, copy)
+    tasks, duplicates = client.FileTriage(processes=2, chunk_size=1).run([first.file_name, copy, second.file_name])
+    assert [task.file_name for task in tasks] == [first.file_name, second.file_name]
+    assert [task.file_name for task in duplicates] == [copy]
+    assert [task.sha256.hash for task in tasks] == [first.sha256.hash, second.sha256.hash]
+
+
+def test_triage_skips_missing_paths_and_directories(client, make_tasks, tmp_path):
+    task, = make_tasks(1)
+    os.mkdir(str(tmp_path / 'directory'))
+    tasks, _ = client.FileTriage(processes=1).run([task.file_name, str(tmp_path / 'directory'), str(tmp_path / 'gone')])
+    assert [task.file_name for task in tasks] == [task.file_name]
+
+
+def test_triage_hashes_unchanged_files_only_once(client, make_tasks, tmp_path):
+    tasks = make_tasks(3)
+    hash_cache = client.HashCache(str(tmp_path / 'hashes.sqlite'))
+    file_names = [task.file_name for task in tasks]
+    triage = client.FileTriage(hash_cache, processes=1)
+    triage.run(file_names)
+    assert (triage.hashed, triage.cached) == (3, 0)
+
+    with open(tasks[0].file_name, 'ab') as fp:
+        fp.write(b'appended')
+    triage = client.FileTriage(hash_cache, processes=1)
+    result, _ = triage.run(file_names)
+    assert (triage.hashed, triage.cached) == (1, 2)
+    assert result[0].sha256.hash == client.Sha256.from_file(tasks[0].file_name).hash
+    assert [task.sha256.hash for task in result[1:]] == [task.sha256.hash for task in tasks[1:]]
@@ -0,0 +1,32 @@
+import io
+import os
+
+
+def test_upload_from_stream_without_file_descriptor(client, api, state):
+    data = os.urandom(100000)
+    upload = api.upload(io.BytesIO(data))
+    assert upload.parent_sha256.hash == client.Sha256.from_data(data).hash
+    assert state.uploads[upload.id].sha256 == upload.parent_sha256.hash
+
+
+def test_upload_starts_at_current_position(client, api, state):
+    fp = io.BytesIO(b'header' + b'payload')
+    fp.seek(6)
+    upload = api.upload(fp)
+    assert state.blobs[state.uploads[upload.id].sha256] == b'payload'
+    assert upload.parent_sha256.hash == client.Sha256.from_data(b'payload').hash
+
+
+def test_upload_does_not_hash_again_when_hash_is_known(client, api, make_tasks, monkeypatch):
+    streams = []
+
+    class RecordingStream(client.MultipartFileStream):
+        def __init__(self, *args, **kwargs):
+            super(RecordingStream, self).__init__(*args, **kwargs)
+            streams.append(self)
+
+    monkeypatch.setattr(client, 'MultipartFileStream', RecordingStream)
+    task, = make_tasks(1)
+    assert api.upload(task.file_name, task.sha256).parent_sha256 is task.sha256
+    assert api.upload(task.file_name).parent_sha256.hash == task.sha256.hash
+    assert [stream.hasher is None for stream in streams] == [True, False]
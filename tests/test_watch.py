@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+import mock_server
+
+
+@pytest.fixture
+def make_pipeline(client, api, tmp_path):
+    def make_pipeline(share: float = 1.):
+        manifest = client.JobManifest(str(tmp_path / 'manifest.sqlite'))
+        scheduler = client.QuotaScheduler(
+            client.QuotaTracker(api, str(tmp_path / 'quota.json')),
+            client.SubmissionBacklog(str(tmp_path / 'backlog.sqlite')),
+            share
+        )
+
+        def on_update(task, upload):
+            manifest.set_upload(task, upload)
+            scheduler.submitted(task)
+
+        poller = client.SubmissionPoller(api, client.PollingStrategy(.05, min_interval=.01), on_update=on_update)
+        return client.WatchPipeline(api, poller, manifest, str(tmp_path / 'output'), scheduler=scheduler)
+    return make_pipeline
+
+
+@pytest.fixture
+def spool(tmp_path, make_tasks):
+    directory = tmp_path / 'spool'
+    directory.mkdir()
+    make_tasks(3, directory=str(directory))
+    return str(directory)
+
+
+def test_watch_stays_within_quota_share(client, make_pipeline, spool, state):
+    state.month_limit = 4
+    pipeline = make_pipeline(.5)
+    watcher = client.DirectoryWatcher(spool, settle=0, scan_interval=.05, use_inotify=False)
+    finished = list(pipeline.run(watcher, once=True))
+    assert [upload.status for _, upload, _ in finished] == [client.UnpacMeStatus.COMPLETE] * 2
+    assert pipeline.manifest.counts() == {'COMPLETE': 2, client.JobManifest.DEFERRED: 1}
+    assert len(pipeline.scheduler.backlog) == 1
+    assert state.request_counts['upload'] == 2
+
+
+def test_watch_marks_rejected_uploads_as_failed(client, make_pipeline, spool, state, monkeypatch):
+    def reject(handler):
+        handler.state.count('upload')
+        handler.discard_body()
+        handler.send_json(400, {'error': 'invalid_file', 'description': 'Not a PE file'})
+
+    monkeypatch.setattr(mock_server.MockUnpacMeHandler, 'do_POST', reject)
+    pipeline = make_pipeline()
+    watcher = client.DirectoryWatcher(spool, settle=0, scan_interval=.05, use_inotify=False)
+    assert len(list(pipeline.run(watcher, once=True))) == 3
+    assert pipeline.manifest.counts() == {'FAIL': 3}
+    assert len(pipeline.scheduler.backlog) == 0
+    assert state.request_counts['upload'] == 3
+    assert not os.listdir(pipeline.output_directory)
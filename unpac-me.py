@@ -1,25 +1,250 @@
 #!/usr/bin/env python3
 import argparse
+import collections
+import concurrent.futures
+import heapq
+import importlib.util
+import itertools
 import logging
+import mmap
 import os
 import datetime
+import queue
+import random
+import re
+import select
+import shlex
 import json
 import glob
+import gzip
 import hashlib
+import shutil
+import sqlite3
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
 import typing
+import urllib.parse
+import uuid
 from enum import Enum
 
-import requests
-import requests.adapters
-
 __version__ = '1.0.0'
 
 
-class FixedTimeoutAdapter(requests.adapters.HTTPAdapter):
-    def send(self, *args, **kwargs):
+def lazy_import(name: str, optional: bool = False):
+    # The module is only executed on first attribute access, so commands which never talk to the API start without
+    # importing the HTTP stack.
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        if optional:
+            return None
+        raise ModuleNotFoundError(F'No module named "{name}"', name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+requests = lazy_import('requests')
+urllib3 = lazy_import('urllib3')
+aiohttp = lazy_import('aiohttp', optional=True)
+pyarrow = lazy_import('pyarrow', optional=True)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: typing.Optional[float] = None):
+        self.rate = rate
+        self.capacity = max(rate, 1.) if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class RequestRecord:
+    __slots__ = ('endpoint', 'method', 'status_code', 'seconds', 'bytes_sent', 'bytes_received', 'retries')
+
+    def __init__(
+            self,
+            endpoint: str,
+            method: str,
+            status_code: int,
+            seconds: float,
+            bytes_sent: int,
+            bytes_received: int,
+            retries: int
+    ):
+        self.endpoint = endpoint
+        self.method = method
+        self.status_code = status_code
+        self.seconds = seconds
+        self.bytes_sent = bytes_sent
+        self.bytes_received = bytes_received
+        self.retries = retries
+
+    def __repr__(self):
+        return F'<RequestRecord {self.method} {self.endpoint} {self.status_code} {self.seconds:.3f}s>'
+
+
+class ApiMetrics:
+    LATENCY_BUCKETS = (.05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+
+    def __init__(self, callback: typing.Optional[typing.Callable[[RequestRecord], None]] = None):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.latency_buckets = collections.defaultdict(lambda: [0] * len(self.LATENCY_BUCKETS))
+        self.latency_sum = collections.Counter()
+        self.retries = collections.Counter()
+        self.polls = collections.Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @staticmethod
+    def endpoint_name(url: str) -> str:
+        path = urllib.parse.urlparse(url).path
+        path = path[path.find('/api/v1') + len('/api/v1'):] if '/api/v1' in path else path
+        segments = []
+        for segment in path.split('/'):
+            if re.fullmatch(r'[0-9a-fA-F]{64}', segment):
+                segment = '{sha256}'
+            elif re.fullmatch(r'[0-9a-fA-F-]{16,}', segment):
+                segment = '{id}'
+            segments.append(segment)
+        return '/'.join(segments)
+
+    def on_response(self, response: 'requests.Response', *args, **kwargs):
+        endpoint = self.endpoint_name(response.request.url)
+        retries = getattr(response.raw, 'retries', None)
+        record = RequestRecord(
+            endpoint,
+            response.request.method,
+            response.status_code,
+            response.elapsed.total_seconds(),
+            int(response.request.headers.get('Content-Length', 0)),
+            int(response.headers.get('Content-Length', 0)),
+            0 if retries is None else len(retries.history)
+        )
+        with self.lock:
+            self.requests[(record.endpoint, record.status_code)] += 1
+            buckets = self.latency_buckets[record.endpoint]
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if record.seconds <= bound:
+                    buckets[i] += 1
+            self.latency_sum[record.endpoint] += record.seconds
+            self.retries[record.endpoint] += record.retries
+            self.bytes_sent += record.bytes_sent
+            self.bytes_received += record.bytes_received
+            if record.endpoint == '/public/status/{id}':
+                self.polls[response.request.url.rsplit('/', 1)[-1]] += 1
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self) -> str:
+        with self.lock:
+            counts = collections.Counter()
+            for (endpoint, _), count in self.requests.items():
+                counts[endpoint] += count
+            lines = [F'{"Endpoint":<32} {"Requests":>8} {"Errors":>8} {"Retries":>8} {"Mean":>8}']
+            for endpoint, count in sorted(counts.items()):
+                errors = sum(c for (e, status_code), c in self.requests.items() if e == endpoint and status_code >= 400)
+                lines.append(
+                    F'{endpoint:<32} {count:>8} {errors:>8} {self.retries[endpoint]:>8} '
+                    F'{self.latency_sum[endpoint] / count:>7.3f}s'
+                )
+            lines.append(
+                F'Sent {self.bytes_sent / 1024 / 1024:.2f} MiB, received {self.bytes_received / 1024 / 1024:.2f} MiB'
+            )
+            if self.polls:
+                lines.append(
+                    F'Polled {len(self.polls)} submission(s) {sum(self.polls.values())} time(s), '
+                    F'at most {max(self.polls.values())} time(s) each'
+                )
+        return '\n'.join(lines)
+
+    def prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            lines.append('# TYPE unpacme_requests_total counter')
+            for (endpoint, status_code), count in sorted(self.requests.items()):
+                lines.append(F'unpacme_requests_total{{endpoint="{endpoint}",code="{status_code}"}} {count}')
+            lines.append('# TYPE unpacme_request_duration_seconds histogram')
+            for endpoint, buckets in sorted(self.latency_buckets.items()):
+                count = sum(c for (e, _), c in self.requests.items() if e == endpoint)
+                label = F'endpoint="{endpoint}"'
+                for bound, bucket in zip(self.LATENCY_BUCKETS, buckets):
+                    lines.append(F'unpacme_request_duration_seconds_bucket{{{label},le="{bound}"}} {bucket}')
+                lines.append(F'unpacme_request_duration_seconds_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(F'unpacme_request_duration_seconds_sum{{{label}}} {self.latency_sum[endpoint]}')
+                lines.append(F'unpacme_request_duration_seconds_count{{{label}}} {count}')
+            lines.append('# TYPE unpacme_retries_total counter')
+            for endpoint, count in sorted(self.retries.items()):
+                lines.append(F'unpacme_retries_total{{endpoint="{endpoint}"}} {count}')
+            lines.append('# TYPE unpacme_bytes_sent_total counter')
+            lines.append(F'unpacme_bytes_sent_total {self.bytes_sent}')
+            lines.append('# TYPE unpacme_bytes_received_total counter')
+            lines.append(F'unpacme_bytes_received_total {self.bytes_received}')
+            lines.append('# TYPE unpacme_polled_submissions gauge')
+            lines.append(F'unpacme_polled_submissions {len(self.polls)}')
+        return '\n'.join(lines) + '\n'
+
+
+class FixedTimeoutAdapter:
+    # Wraps instead of subclassing HTTPAdapter, which would import requests as soon as this script is loaded.
+    def __init__(
+            self,
+            timeout: float = 5,
+            rate_limiter: typing.Optional[TokenBucket] = None,
+            retry: typing.Optional['urllib3.util.Retry'] = None,
+            **kwargs
+    ):
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.retry = retry
+        self.adapter = requests.adapters.HTTPAdapter(**kwargs)
+
+    def send(self, request: 'requests.PreparedRequest', **kwargs) -> 'requests.Response':
         if kwargs['timeout'] is None:
-            kwargs['timeout'] = 5
-        return super(FixedTimeoutAdapter, self).send(*args, **kwargs)
+            kwargs['timeout'] = self.timeout
+        # Retries on status codes happen here instead of inside urllib3 so that every attempt takes a token.
+        retry = self.retry
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            response = self.adapter.send(request, **kwargs)
+            if retry is None or not retry.is_retry(
+                    request.method, response.status_code, 'Retry-After' in response.headers
+            ):
+                break
+            try:
+                retry = retry.increment(request.method, request.url, response=response.raw)
+            except urllib3.exceptions.MaxRetryError:
+                break
+            response.close()
+            retry.sleep(response.raw)
+        if retry is not None and retry.history:
+            response.raw.retries = retry
+        return response
+
+    def close(self):
+        self.adapter.close()
 
 
 class UnpacMeStatus(Enum):
@@ -61,8 +286,12 @@ class UnpacMeStatus(Enum):
     # guarantee.
     FAIL = 9
 
+    @property
+    def terminal(self) -> bool:
+        return self in (UnpacMeStatus.COMPLETE, UnpacMeStatus.FAIL)
+
     @staticmethod
-    def from_string(status: str):
+    def from_string(status: str) -> 'UnpacMeStatus':
         if status == 'validating':
             return UnpacMeStatus.VALIDATING
         elif status == 'queued':
@@ -81,26 +310,66 @@ class UnpacMeStatus(Enum):
             return UnpacMeStatus.COMPLETE
         elif status == 'fail':
             return UnpacMeStatus.FAIL
+        # Statuses introduced by the API later on must not break polling or the history index.
+        return UnpacMeStatus.UNKNOWN
 
 
 class Sha256:
+    __slots__ = ('digest',)
+
     def __init__(self, sha256):
         if len(sha256) != 64:
             raise Exception(F'Invalid SHA256 hash: "{repr(sha256)}"')
-        self.hash = sha256
+        try:
+            self.digest = bytes.fromhex(sha256)
+        except ValueError:
+            raise Exception(F'Invalid SHA256 hash: "{repr(sha256)}"')
+
+    @property
+    def hash(self) -> str:
+        return self.digest.hex()
+
+    @staticmethod
+    def from_digest(digest: bytes):
+        sha256 = Sha256.__new__(Sha256)
+        sha256.digest = digest
+        return sha256
 
     @staticmethod
     def from_data(data):
-        return Sha256(hashlib.sha256(data).hexdigest())
+        return Sha256.from_digest(hashlib.sha256(data).digest())
+
+    @staticmethod
+    def from_file(file: typing.Union[str, typing.BinaryIO], chunk_size: int = 1024 * 1024):
+        if isinstance(file, str):
+            with open(file, 'rb') as fp:
+                return Sha256.from_file(fp, chunk_size)
+        hasher = hashlib.sha256()
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            hasher.update(chunk)
+        return Sha256.from_digest(hasher.digest())
+
+    @staticmethod
+    def from_mapped_file(file_name: str):
+        with open(file_name, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return Sha256.from_data(b'')
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return Sha256.from_data(data)
 
     def __repr__(self):
         return F'<Sha256 {self.hash}>'
 
     def __eq__(self, other):
-        return self.hash == other.hash
+        return isinstance(other, Sha256) and self.digest == other.digest
+
+    def __hash__(self):
+        return hash(self.digest)
 
 
 class UnpacMeUpload:
+    __slots__ = ('id', 'status', 'created', 'parent_sha256')
+
     def __init__(self, id, status: UnpacMeStatus, created: datetime.datetime, parent_sha256: typing.Optional[Sha256]):
         self.id = id
         self.status = status
@@ -110,8 +379,19 @@ class UnpacMeUpload:
     def __repr__(self):
         return F'<UnpacMeUpload {self.id} {self.status} {self.created.strftime("%Y-%m-%d %H:%M:%S")}>'
 
+    @staticmethod
+    def from_history_result(result):
+        return UnpacMeUpload(
+            result['id'],
+            UnpacMeStatus.from_string(result['status']),
+            datetime.datetime.utcfromtimestamp(result['created']),
+            Sha256(result['sha256'])
+        )
+
 
 class UnpacMeQuota:
+    __slots__ = ('api_key', 'total_submissions', 'month_submissions', 'month_limit', 'roles')
+
     def __init__(
             self,
             api_key: str,
@@ -128,8 +408,33 @@ class UnpacMeQuota:
         return F'<UnpacMeQuota roles={self.roles} ' \
                F'total={self.total_submissions} month={self.month_submissions}/{self.month_limit}>'
 
+    @property
+    def remaining(self) -> int:
+        return max(self.month_limit - self.month_submissions, 0)
+
+    def to_json(self) -> typing.Dict:
+        return {
+            'api_key': self.api_key,
+            'total_submissions': self.total_submissions,
+            'month_submissions': self.month_submissions,
+            'month_limit': self.month_limit,
+            'roles': self.roles,
+        }
+
+    @staticmethod
+    def from_json(j):
+        return UnpacMeQuota(
+            j['api_key'],
+            j['total_submissions'],
+            j['month_submissions'],
+            j['month_limit'],
+            j['roles'],
+        )
+
 
 class UnpacMeUnpackedSample:
+    __slots__ = ('sha256', 'malware_names', 'autoit_original_file_name', 'autoit_sha256')
+
     def __init__(self, sha256: Sha256, malware_names: typing.List):
         self.sha256 = sha256
         self.malware_names = malware_names
@@ -152,17 +457,32 @@ class UnpacMeUnpackedSample:
 
 
 class UnpacMeResults:
+    __slots__ = ('raw_json', 'sha256', 'status', '_samples')
+
     def __init__(self, raw_json):
         self.raw_json = raw_json
         self.sha256 = Sha256(raw_json['sha256'])
         self.status = UnpacMeStatus.from_string(raw_json['status'])
-        self.samples = [UnpacMeUnpackedSample.from_result(result) for result in raw_json['results']]
+        self._samples = None
+
+    @property
+    def samples(self) -> typing.List[UnpacMeUnpackedSample]:
+        if self._samples is None:
+            self._samples = list(self.iter_samples())
+        return self._samples
+
+    def iter_samples(self) -> typing.Iterator[UnpacMeUnpackedSample]:
+        if self._samples is not None:
+            return iter(self._samples)
+        return (UnpacMeUnpackedSample.from_result(result) for result in self.raw_json['results'])
 
     def __repr__(self):
         return F'<UnpacMeResults status={self.status}>'
 
 
 class FeedEntry:
+    __slots__ = ('upload', 'sha256', 'malware_tags', 'created', 'children', 'child_count')
+
     def __init__(
             self,
             upload: UnpacMeUpload,
@@ -184,6 +504,103 @@ class FeedEntry:
                F'{self.created.strftime("%Y-%m-%d %H:%M:%S")} ' \
                F'{self.upload.id} {self.sha256.hash}>'
 
+    def to_json(self) -> typing.Dict:
+        return {
+            'id': self.upload.id,
+            'sha256': self.sha256.hash,
+            'status': self.upload.status.name.lower(),
+            'created': self.created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'malware_tags': self.malware_tags,
+            'children': [child.hash for child in self.children],
+            'child_count': self.child_count if isinstance(self.child_count, int) else len(self.children),
+        }
+
+    @staticmethod
+    def from_search_result(result):
+        sha256 = Sha256(result['sha256'])
+        created = datetime.datetime.utcfromtimestamp(result['created'])
+        return FeedEntry(
+            UnpacMeUpload(result['submission_id'], UnpacMeStatus.from_string(result['status']), created, sha256),
+            sha256,
+            [],
+            created,
+            [Sha256(sha256) for sha256 in result['children']]
+        )
+
+    @staticmethod
+    def from_feed_result(result):
+        sha256 = Sha256(result['sha256'])
+        created = datetime.datetime.utcfromtimestamp(result['created'])
+        return FeedEntry(
+            UnpacMeUpload(result['id'], UnpacMeStatus.from_string(result['status']), created, sha256),
+            sha256,
+            [malware['match'] for malware in result['malwareid']],
+            created,
+            [Sha256(sha256) for sha256 in result['children']] if isinstance(result['children'], list) else [],
+            result['children']
+        )
+
+
+class UploadTask:
+    def __init__(self, file_name: str, sha256: Sha256):
+        self.file_name = file_name
+        self.sha256 = sha256
+
+    def __repr__(self):
+        return F'<UploadTask {self.file_name} {self.sha256.hash}>'
+
+
+class MultipartFileStream:
+    def __init__(
+            self,
+            fp: typing.BinaryIO,
+            size: int,
+            field_name: str = 'file',
+            file_name: str = 'file',
+            compute_sha256: bool = True
+    ):
+        self.fp = fp
+        self.boundary = uuid.uuid4().hex
+        self.hasher = hashlib.sha256() if compute_sha256 else None
+        self.head = (
+            F'--{self.boundary}\r\n'
+            F'Content-Disposition: form-data; name="{field_name}"; filename="{file_name}"\r\n'
+            F'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode('utf-8')
+        self.tail = F'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self.len = len(self.head) + size + len(self.tail)
+        self.file_remaining = size
+
+    @property
+    def content_type(self) -> str:
+        return F'multipart/form-data; boundary={self.boundary}'
+
+    @property
+    def sha256(self) -> typing.Optional[Sha256]:
+        return None if self.hasher is None else Sha256.from_digest(self.hasher.digest())
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.len
+        parts = []
+        if self.head and size > 0:
+            parts.append(self.head[:size])
+            self.head = self.head[size:]
+            size -= len(parts[-1])
+        if self.file_remaining and size > 0:
+            chunk = self.fp.read(min(size, self.file_remaining))
+            if len(chunk) == 0:
+                raise ApiException('File shrunk while being uploaded')
+            if self.hasher is not None:
+                self.hasher.update(chunk)
+            self.file_remaining -= len(chunk)
+            parts.append(chunk)
+            size -= len(chunk)
+        if not self.file_remaining and self.tail and size > 0:
+            parts.append(self.tail[:size])
+            self.tail = self.tail[size:]
+        return b''.join(parts)
+
 
 class ApiException(Exception):
     pass
@@ -199,51 +616,764 @@ class HashNotFoundApiException(ApiException):
     pass
 
 
+class UploadRejectedApiException(ApiException):
+    pass
+
+
+class HashMismatchApiException(ApiException):
+    def __init__(self, expected: Sha256, actual: Sha256):
+        super(HashMismatchApiException, self).__init__(F'Expected {expected.hash} but received {actual.hash}')
+        self.expected = expected
+        self.actual = actual
+
+
+class ResultCache:
+    KIND_RESULTS = 'results'
+    KIND_SEARCH = 'search'
+    KIND_BLOB = 'blob'
+    EVICT_TO = .9
+
+    def __init__(self, directory: str, max_size: typing.Optional[int] = None, max_age: typing.Optional[float] = None):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, 'cache.sqlite'), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT, size INTEGER NOT NULL, stored_at REAL NOT NULL, '
+            'PRIMARY KEY (kind, key))'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS entries_stored_at ON entries (stored_at)')
+        self.connection.commit()
+        self.total_size = 0
+        self.evict()
+
+    @staticmethod
+    def default_directory() -> str:
+        return os.path.join(
+            os.getenv('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'unpac-me'
+        )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _get(self, kind: str, key: str) -> typing.Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value, stored_at FROM entries WHERE kind = ? AND key = ?', (kind, key)
+            ).fetchone()
+        if row is None or (self.max_age is not None and row[1] < time.time() - self.max_age):
+            return None
+        return row[0]
+
+    def _put(self, kind: str, key: str, value: typing.Optional[str], size: int):
+        # A running total avoids summing up the whole table on every put. It only triggers the eviction, which counts
+        # again exactly, so entries written by other processes are accounted for there.
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT size FROM entries WHERE kind = ? AND key = ?', (kind, key)
+            ).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entries (kind, key, value, size, stored_at) VALUES (?, ?, ?, ?, ?)',
+                (kind, key, value, size, time.time())
+            )
+            self.connection.commit()
+            self.total_size += size - (0 if row is None else row[0])
+            exceeded = self.max_size is not None and self.total_size > self.max_size
+        if exceeded:
+            self.evict()
+
+    def get_results(self, upload_id: str) -> typing.Optional[typing.Dict]:
+        value = self._get(self.KIND_RESULTS, upload_id)
+        return None if value is None else json.loads(value)
+
+    def put_results(self, upload_id: str, raw_json: typing.Dict):
+        value = json.dumps(raw_json, separators=(',', ':'))
+        self._put(self.KIND_RESULTS, upload_id, value, len(value))
+
+    def get_search(self, sha256: Sha256) -> typing.Optional[typing.List]:
+        value = self._get(self.KIND_SEARCH, sha256.hash)
+        return None if value is None else json.loads(value)
+
+    def put_search(self, sha256: Sha256, results: typing.List):
+        value = json.dumps(results, separators=(',', ':'))
+        self._put(self.KIND_SEARCH, sha256.hash, value, len(value))
+
+    def known_hashes(self) -> typing.Set[str]:
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT key FROM entries WHERE kind = ? AND value != ? AND stored_at >= ?',
+                (self.KIND_SEARCH, '[]', 0 if self.max_age is None else time.time() - self.max_age)
+            ).fetchall()
+        return {key for key, in rows}
+
+    def blob_path(self, sha256: Sha256) -> str:
+        return os.path.join(self.directory, 'blobs', sha256.hash[:2], sha256.hash)
+
+    def get_blob(self, sha256: Sha256) -> typing.Optional[str]:
+        if self._get(self.KIND_BLOB, sha256.hash) is None:
+            return None
+        blob_path = self.blob_path(sha256)
+        return blob_path if os.path.isfile(blob_path) else None
+
+    def put_blob(self, sha256: Sha256, source: typing.Union[str, bytes]):
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        fd, temp_file_name = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(blob_path))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                if isinstance(source, bytes):
+                    fp.write(source)
+                else:
+                    with open(source, 'rb') as source_fp:
+                        shutil.copyfileobj(source_fp, fp)
+            os.replace(temp_file_name, blob_path)
+        except BaseException:
+            os.unlink(temp_file_name)
+            raise
+        self._put(self.KIND_BLOB, sha256.hash, '', os.path.getsize(blob_path))
+
+    def _delete(self, rows: typing.List[typing.Tuple[str, str]]):
+        for kind, key in rows:
+            if kind == self.KIND_BLOB:
+                try:
+                    os.unlink(self.blob_path(Sha256(key)))
+                except FileNotFoundError:
+                    pass
+        self.connection.executemany('DELETE FROM entries WHERE kind = ? AND key = ?', rows)
+
+    def evict(self):
+        with self.lock:
+            if self.max_age is not None:
+                self._delete(self.connection.execute(
+                    'SELECT kind, key FROM entries WHERE stored_at < ?', (time.time() - self.max_age,)
+                ).fetchall())
+            total_size, = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+            if self.max_size is not None and total_size > self.max_size:
+                # Evicting below the limit leaves room for the next puts before the table is counted again.
+                target_size = self.max_size * self.EVICT_TO
+                evicted = []
+                for kind, key, size in self.connection.execute(
+                        'SELECT kind, key, size FROM entries ORDER BY stored_at'
+                ):
+                    if total_size <= target_size:
+                        break
+                    evicted.append((kind, key))
+                    total_size -= size
+                self._delete(evicted)
+            self.total_size = total_size
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self._delete(self.connection.execute('SELECT kind, key FROM entries').fetchall())
+            self.total_size = 0
+            self.connection.commit()
+
+
+class HistoryIndex:
+    def __init__(self, file_name: str):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS uploads ('
+            'id TEXT PRIMARY KEY, sha256 TEXT NOT NULL, status TEXT NOT NULL, created REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS uploads_sha256 ON uploads (sha256)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS uploads_created ON uploads (created)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _get_meta(self, key: str) -> typing.Optional[str]:
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, key: str, value: typing.Optional[str]):
+        self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def _store(self, uploads: typing.List[UnpacMeUpload]) -> bool:
+        known_terminal = False
+        for upload in uploads:
+            row = self.connection.execute('SELECT status FROM uploads WHERE id = ?', (upload.id,)).fetchone()
+            known_terminal = known_terminal or (row is not None and UnpacMeStatus[row[0]].terminal)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO uploads (id, sha256, status, created) VALUES (?, ?, ?, ?)',
+                (
+                    upload.id,
+                    upload.parent_sha256.hash,
+                    upload.status.name,
+                    upload.created.replace(tzinfo=datetime.timezone.utc).timestamp()
+                )
+            )
+        return known_terminal
+
+    def sync(self, api: 'UnpacMeApi', page_size: int = 100) -> int:
+        with self.lock:
+            count_before, = self.connection.execute('SELECT COUNT(*) FROM uploads').fetchone()
+
+            # The initial sync walks the whole history and remembers the cursor of every page, so an interrupted run
+            # continues where it stopped.
+            if self._get_meta('backfill_complete') != '1':
+                for uploads, cursor in api.history_pages(cursor=self._get_meta('cursor'), page_size=page_size):
+                    self._store(uploads)
+                    if cursor:
+                        self._set_meta('cursor', cursor)
+                    self.connection.commit()
+                self._set_meta('backfill_complete', '1')
+                self.connection.commit()
+
+            # Newest entries come first, so once a page reaches an upload that was already indexed in its final state
+            # everything after it is known as well, except for older uploads that were indexed before they finished.
+            # Those are refreshed one by one, so a single stuck submission does not turn every sync into a full walk.
+            pending = {
+                id for id, in self.connection.execute(
+                    'SELECT id FROM uploads WHERE status NOT IN (?, ?)',
+                    (UnpacMeStatus.COMPLETE.name, UnpacMeStatus.FAIL.name)
+                )
+            }
+            for uploads, _ in api.history_pages(page_size=page_size):
+                reached_known = self._store(uploads)
+                self.connection.commit()
+                pending.difference_update(upload.id for upload in uploads)
+                if reached_known:
+                    break
+            for id in pending:
+                try:
+                    status = api.status(UnpacMeUpload(id, UnpacMeStatus.UNKNOWN, datetime.datetime.now(), None))
+                except ApiException:
+                    continue
+                self.connection.execute('UPDATE uploads SET status = ? WHERE id = ?', (status.name, id))
+            self.connection.commit()
+
+            count_after, = self.connection.execute('SELECT COUNT(*) FROM uploads').fetchone()
+        return count_after - count_before
+
+    def query(
+            self,
+            sha256: typing.Optional[Sha256] = None,
+            since: typing.Optional[datetime.datetime] = None,
+            until: typing.Optional[datetime.datetime] = None,
+            status: typing.Optional[UnpacMeStatus] = None
+    ) -> typing.Iterator[UnpacMeUpload]:
+        conditions, params = [], []
+        if sha256 is not None:
+            conditions.append('sha256 = ?')
+            params.append(sha256.hash)
+        if since is not None:
+            conditions.append('created >= ?')
+            params.append(since.replace(tzinfo=datetime.timezone.utc).timestamp())
+        if until is not None:
+            conditions.append('created < ?')
+            params.append(until.replace(tzinfo=datetime.timezone.utc).timestamp())
+        if status is not None:
+            conditions.append('status = ?')
+            params.append(status.name)
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, sha256, status, created FROM uploads '
+                F'{"WHERE " + " AND ".join(conditions) if conditions else ""} ORDER BY created DESC',
+                params
+            ).fetchall()
+        for id, sha256_hash, status_name, created in rows:
+            yield UnpacMeUpload(
+                id,
+                UnpacMeStatus[status_name],
+                datetime.datetime.utcfromtimestamp(created),
+                Sha256(sha256_hash)
+            )
+
+    def hashes(self) -> typing.Set[str]:
+        with self.lock:
+            return {sha256 for sha256, in self.connection.execute('SELECT DISTINCT sha256 FROM uploads')}
+
+
+class JobManifest:
+    PENDING = 'PENDING'
+    KNOWN = 'KNOWN'
+    DEFERRED = 'DEFERRED'
+
+    def __init__(self, file_name: str):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'file_name TEXT PRIMARY KEY, sha256 TEXT NOT NULL, upload_id TEXT, status TEXT NOT NULL, summary TEXT, '
+            'updated REAL NOT NULL)'
+        )
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _update(self, file_name: str, **columns):
+        columns['updated'] = time.time()
+        with self.lock:
+            self.connection.execute(
+                F'UPDATE jobs SET {", ".join(F"{column} = ?" for column in columns)} WHERE file_name = ?',
+                list(columns.values()) + [os.path.abspath(file_name)]
+            )
+            self.connection.commit()
+
+    def add_tasks(self, tasks: typing.Iterable[UploadTask], status: str = PENDING):
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO jobs (file_name, sha256, status, updated) VALUES (?, ?, ?, ?)',
+                ((os.path.abspath(task.file_name), task.sha256.hash, status, time.time()) for task in tasks)
+            )
+            self.connection.commit()
+
+    def set_status(self, file_name: str, status: str):
+        self._update(file_name, status=status)
+
+    def set_upload(self, task: UploadTask, upload: UnpacMeUpload):
+        self._update(task.file_name, upload_id=upload.id, status=upload.status.name)
+
+    def set_results(self, task: UploadTask, upload: UnpacMeUpload, results: typing.Optional[UnpacMeResults]):
+        summary = None if results is None else json.dumps({
+            'samples': len(results.raw_json['results']),
+            'malware_names': sorted({name for sample in results.iter_samples() for name in sample.malware_names}),
+        })
+        self._update(task.file_name, status=upload.status.name, summary=summary)
+
+    def pending_tasks(self) -> typing.List[UploadTask]:
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT file_name, sha256 FROM jobs WHERE status = ? ORDER BY file_name', (self.PENDING,)
+            ).fetchall()
+        return [UploadTask(file_name, Sha256(sha256)) for file_name, sha256 in rows]
+
+    def running_uploads(self) -> typing.List[typing.Tuple[UploadTask, UnpacMeUpload]]:
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT file_name, sha256, upload_id, status FROM jobs WHERE upload_id IS NOT NULL AND status NOT IN '
+                '(?, ?) ORDER BY file_name',
+                (UnpacMeStatus.COMPLETE.name, UnpacMeStatus.FAIL.name)
+            ).fetchall()
+        return [(
+            UploadTask(file_name, Sha256(sha256)),
+            UnpacMeUpload(upload_id, UnpacMeStatus[status], datetime.datetime.now(), Sha256(sha256))
+        ) for file_name, sha256, upload_id, status in rows]
+
+    def counts(self) -> typing.Dict[str, int]:
+        with self.lock:
+            return dict(self.connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def hashes(self) -> typing.Set[str]:
+        with self.lock:
+            return {sha256 for sha256, in self.connection.execute('SELECT DISTINCT sha256 FROM jobs')}
+
+
+class HashCache:
+    def __init__(self, file_name: str):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            'file_name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, sha256 BLOB NOT NULL)'
+        )
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, file_name: str, result: os.stat_result) -> typing.Optional[Sha256]:
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT sha256 FROM hashes WHERE file_name = ? AND size = ? AND mtime = ?',
+                (file_name, result.st_size, result.st_mtime_ns)
+            ).fetchone()
+        return None if row is None else Sha256.from_digest(row[0])
+
+    def put(self, entries: typing.Iterable[typing.Tuple[str, os.stat_result, Sha256]]):
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO hashes (file_name, size, mtime, sha256) VALUES (?, ?, ?, ?)',
+                (
+                    (file_name, result.st_size, result.st_mtime_ns, sha256.digest)
+                    for file_name, result, sha256 in entries
+                )
+            )
+            self.connection.commit()
+
+
+class QuotaTracker:
+    def __init__(self, api: 'UnpacMeApi', file_name: str, max_age: float = 15 * 60):
+        self.api = api
+        self.file_name = file_name
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self._quota = None
+        self._fetched = 0.
+        if os.path.exists(file_name):
+            with open(file_name, 'r') as fp:
+                j = json.load(fp)
+            self._quota = UnpacMeQuota.from_json(j['quota'])
+            self._fetched = j['fetched']
+
+    def _expired(self, now: float) -> bool:
+        if self._quota is None or now - self._fetched >= self.max_age:
+            return True
+        # Monthly submissions start over at the beginning of every month.
+        fetched, current = (datetime.datetime.fromtimestamp(t, datetime.timezone.utc) for t in (self._fetched, now))
+        return (fetched.year, fetched.month) != (current.year, current.month)
+
+    def _save(self):
+        fd, temp_file_name = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(os.path.abspath(self.file_name)))
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'fetched': self._fetched, 'quota': self._quota.to_json()}, fp)
+        os.replace(temp_file_name, self.file_name)
+
+    def quota(self) -> UnpacMeQuota:
+        with self.lock:
+            now = time.time()
+            if self._expired(now):
+                self._quota = self.api.get_quota()
+                self._fetched = now
+                self._save()
+            return self._quota
+
+    def consume(self, count: int = 1):
+        quota = self.quota()
+        with self.lock:
+            quota.month_submissions += count
+            quota.total_submissions += count
+            self._save()
+
+
+class SubmissionBacklog:
+    def __init__(self, file_name: str):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS backlog ('
+            'file_name TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL, priority INTEGER NOT NULL, '
+            'added REAL NOT NULL)'
+        )
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM backlog').fetchone()[0]
+
+    def add(self, tasks: typing.Iterable[UploadTask], priority: int = 0):
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO backlog (file_name, sha256, size, priority, added) VALUES (?, ?, ?, ?, ?)',
+                ((
+                    os.path.abspath(task.file_name), task.sha256.hash, os.path.getsize(task.file_name), priority,
+                    time.time()
+                ) for task in tasks)
+            )
+            self.connection.commit()
+
+    def prune(self) -> typing.List[str]:
+        # Files deleted or modified since they were deferred cannot be uploaded with the recorded hash anymore.
+        with self.lock:
+            stale = []
+            for file_name, size in self.connection.execute('SELECT file_name, size FROM backlog').fetchall():
+                try:
+                    if os.path.getsize(file_name) == size:
+                        continue
+                except OSError:
+                    pass
+                stale.append(file_name)
+            self.connection.executemany(
+                'DELETE FROM backlog WHERE file_name = ?', ((file_name,) for file_name in stale)
+            )
+            self.connection.commit()
+        return stale
+
+    def peek(self, count: typing.Optional[int] = None, largest_first: bool = False) -> typing.List[UploadTask]:
+        with self.lock:
+            rows = self.connection.execute(
+                F'SELECT file_name, sha256 FROM backlog '
+                F'ORDER BY priority DESC, size {"DESC" if largest_first else "ASC"}, added LIMIT ?',
+                (-1 if count is None else count,)
+            ).fetchall()
+        return [UploadTask(file_name, Sha256(sha256)) for file_name, sha256 in rows]
+
+    def remove(self, task: UploadTask) -> bool:
+        with self.lock:
+            cursor = self.connection.execute(
+                'DELETE FROM backlog WHERE file_name = ?', (os.path.abspath(task.file_name),)
+            )
+            self.connection.commit()
+            return cursor.rowcount > 0
+
+
+class QuotaScheduler:
+    def __init__(
+            self,
+            tracker: QuotaTracker,
+            backlog: SubmissionBacklog,
+            share: float = 1.,
+            largest_first: bool = False
+    ):
+        self.tracker = tracker
+        self.backlog = backlog
+        self.share = share
+        self.largest_first = largest_first
+        self.allowance = None
+        self.allowance_month = None
+        self.used = 0
+        self.logger = logging.getLogger('UnpacMeClient')
+
+    @property
+    def budget(self) -> int:
+        # The share applies to the quota remaining when the scheduler first looks at it in a month, so a long-running
+        # watch scheduling again and again stays within it as well. Rounding down alone would never submit anything
+        # once few submissions are left.
+        remaining = self.tracker.quota().remaining
+        month = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m')
+        if self.allowance_month != month:
+            self.allowance = max(1, int(remaining * self.share)) if remaining > 0 else 0
+            self.allowance_month = month
+            self.used = 0
+        return max(0, min(remaining, self.allowance - self.used))
+
+    def schedule(self, tasks: typing.Iterable[UploadTask] = (), priority: int = 0) -> typing.List[UploadTask]:
+        self.backlog.add(tasks, priority)
+        for file_name in self.backlog.prune():
+            self.logger.warning(F'Dropping "{file_name}" from the backlog because it was deleted or modified.')
+        return self.backlog.peek(self.budget, self.largest_first)
+
+    def submitted(self, task: UploadTask):
+        if self.backlog.remove(task):
+            self.tracker.consume()
+            self.used += 1
+
+
 class UnpacMeApi:
     BASE_URL = 'https://api.unpac.me/api/v1'
 
-    def __init__(self, api_key, user_agent):
-        self.session = requests.session()
-        self.session.mount('https://', FixedTimeoutAdapter())
-        self.session.mount('http://', FixedTimeoutAdapter())
-        self.session.headers = {
-            'User-Agent': user_agent,
-            'Authorization': F'Key {api_key}',
+    def __init__(
+            self,
+            api_key,
+            user_agent=None,
+            cache: typing.Optional[ResultCache] = None,
+            timeout: float = 5,
+            upload_timeout: float = 120,
+            pool_size: int = 10,
+            retries: int = 3,
+            rate_limit: typing.Optional[float] = None,
+            metrics: typing.Optional[ApiMetrics] = None
+    ):
+        self.api_key = api_key
+        self.user_agent = user_agent
+        self.cache = cache
+        self.metrics = metrics
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.rate_limiter = None if rate_limit is None else TokenBucket(rate_limit)
+        self.lock = threading.Lock()
+        self._session = None
+
+    @staticmethod
+    def default_user_agent() -> str:
+        import platform
+        return F'UnpacMeClient/{__version__} (python-requests {requests.__version__}) ' \
+               F'{platform.system()} ({platform.release()})'
+
+    @property
+    def session(self) -> 'requests.Session':
+        with self.lock:
+            if self._session is None:
+                self._session = self._create_session()
+            return self._session
+
+    def _create_session(self) -> 'requests.Session':
+        # Only idempotent requests are retried on server errors, see upload for how 429 is handled there. urllib3 itself
+        # only retries failed connections.
+        retry = urllib3.util.Retry(
+            total=self.retries,
+            backoff_factor=.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = FixedTimeoutAdapter(
+            self.timeout,
+            self.rate_limiter,
+            retry,
+            pool_maxsize=self.pool_size,
+            max_retries=retry.new(status_forcelist=frozenset(), respect_retry_after_header=False),
+        )
+        session = requests.session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if self.user_agent is None:
+            self.user_agent = self.default_user_agent()
+        logging.getLogger('UnpacMeClient').debug(F'Using User-Agent string: {self.user_agent}')
+        session.headers = {
+            'User-Agent': self.user_agent,
+            'Authorization': F'Key {self.api_key}',
         }
+        if self.metrics is not None:
+            session.hooks['response'].append(self.metrics.on_response)
+        return session
 
-    def upload(self, data: bytes) -> UnpacMeUpload:
-        response = self.session.post(F'{self.BASE_URL}/private/upload', files={'file': data})
+    def upload(
+            self,
+            data: typing.Union[bytes, str, typing.BinaryIO],
+            sha256: typing.Optional[Sha256] = None
+    ) -> UnpacMeUpload:
+        if isinstance(data, str):
+            with open(data, 'rb') as fp:
+                return self.upload(fp, sha256)
+        # The streamed body cannot be replayed by urllib3, so a 429 is retried here with a fresh stream.
+        start = size = None
+        if not isinstance(data, bytes):
+            # Seeking instead of fstat also works for streams without a file descriptor, e.g. io.BytesIO.
+            start = data.tell()
+            size = data.seek(0, os.SEEK_END) - start
+        for attempt in itertools.count():
+            if start is None:
+                response = self.session.post(
+                    F'{self.BASE_URL}/private/upload', files={'file': data}, timeout=self.upload_timeout
+                )
+            else:
+                data.seek(start)
+                stream = MultipartFileStream(data, size, compute_sha256=sha256 is None)
+                response = self.session.post(
+                    F'{self.BASE_URL}/private/upload',
+                    data=stream,
+                    headers={'Content-Type': stream.content_type},
+                    timeout=self.upload_timeout
+                )
+            if response.status_code != 429 or attempt >= self.retries:
+                break
+            time.sleep(self.retry_after(response, attempt))
+        if sha256 is None:
+            sha256 = Sha256.from_data(data) if start is None else stream.sha256
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            raise UploadRejectedApiException(F'Api-Exception: {response.content}')
         if response.status_code != 200:
             raise ApiException(F'Api-Exception: {response.content}')
         return UnpacMeUpload(
             response.json()['id'],
             UnpacMeStatus.UNKNOWN,
             datetime.datetime.now(),
-            Sha256.from_data(data)
+            sha256
         )
 
+    @staticmethod
+    def retry_after(response: 'requests.Response', attempt: int) -> float:
+        try:
+            return max(0., float(response.headers['Retry-After']))
+        except (KeyError, ValueError):
+            return .5 * 2 ** attempt
+
     def status(self, upload: UnpacMeUpload) -> UnpacMeStatus:
+        if self.cache is not None:
+            raw_json = self.cache.get_results(upload.id)
+            if raw_json is not None:
+                return UnpacMeStatus.from_string(raw_json['status'])
         response = self.session.get(F'{self.BASE_URL}/public/status/{upload.id}')
         if response.status_code != 200:
             raise ApiException(F'Api-Exception: {response.content}')
         return UnpacMeStatus.from_string(response.json()['status'])
 
     def results(self, upload: UnpacMeUpload) -> UnpacMeResults:
+        if self.cache is not None:
+            raw_json = self.cache.get_results(upload.id)
+            if raw_json is not None:
+                return UnpacMeResults(raw_json)
         response = self.session.get(F'{self.BASE_URL}/public/results/{upload.id}')
         if response.status_code != 200:
             raise ApiException(F'Api-Exception: {response.content}')
-        return UnpacMeResults(response.json())
+        results = UnpacMeResults(response.json())
+        if self.cache is not None and results.status.terminal:
+            self.cache.put_results(upload.id, results.raw_json)
+        return results
 
     def download(self, sha256: Sha256) -> bytes:
+        if self.cache is not None:
+            blob_path = self.cache.get_blob(sha256)
+            if blob_path is not None:
+                with open(blob_path, 'rb') as fp:
+                    return fp.read()
         response = self.session.get(F'{self.BASE_URL}/private/download/{sha256.hash}')
         if response.status_code != 200:
             raise ApiException(F'Api-Exception: {response.content}')
+        if self.cache is not None and Sha256.from_data(response.content) == sha256:
+            self.cache.put_blob(sha256, response.content)
         return response.content
 
-    def history(self) -> typing.Iterator[UnpacMeUpload]:
-        cursor = None
+    def download_to_file(
+            self,
+            sha256: Sha256,
+            target: typing.Union[str, typing.BinaryIO],
+            chunk_size: int = 64 * 1024
+    ) -> int:
+        blob_path = None if self.cache is None else self.cache.get_blob(sha256)
+        if not isinstance(target, str):
+            if blob_path is None:
+                return self._stream_download(sha256, target, chunk_size)
+            with open(blob_path, 'rb') as fp:
+                shutil.copyfileobj(fp, target, chunk_size)
+            return os.path.getsize(blob_path)
+
+        fd, temp_file_name = tempfile.mkstemp(
+            prefix=F'.{os.path.basename(target)}.', suffix='.part', dir=os.path.dirname(os.path.abspath(target))
+        )
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                if blob_path is None:
+                    size = self._stream_download(sha256, fp, chunk_size)
+                else:
+                    with open(blob_path, 'rb') as blob_fp:
+                        shutil.copyfileobj(blob_fp, fp, chunk_size)
+                    size = fp.tell()
+            os.replace(temp_file_name, target)
+        except BaseException:
+            os.unlink(temp_file_name)
+            raise
+        if self.cache is not None and blob_path is None:
+            self.cache.put_blob(sha256, target)
+        return size
+
+    def _stream_download(self, sha256: Sha256, fp: typing.BinaryIO, chunk_size: int) -> int:
+        with self.session.get(F'{self.BASE_URL}/private/download/{sha256.hash}', stream=True) as response:
+            if response.status_code != 200:
+                raise ApiException(F'Api-Exception: {response.content}')
+            hasher = hashlib.sha256()
+            size = 0
+            for chunk in response.iter_content(chunk_size):
+                hasher.update(chunk)
+                fp.write(chunk)
+                size += len(chunk)
+        actual = Sha256.from_digest(hasher.digest())
+        if actual != sha256:
+            raise HashMismatchApiException(sha256, actual)
+        return size
+
+    def history(self, page_size: int = 10) -> typing.Iterator[UnpacMeUpload]:
+        for uploads, _ in self.history_pages(page_size=page_size):
+            yield from uploads
+
+    def history_pages(self, cursor=None, page_size: int = 10) \
+            -> typing.Iterator[typing.Tuple[typing.List[UnpacMeUpload], typing.Optional[str]]]:
         while True:
-            response = self.session.get(F'{self.BASE_URL}/private/history', params={'cursor': cursor, 'limit': 10})
+            response = self.session.get(
+                F'{self.BASE_URL}/private/history', params={'cursor': cursor, 'limit': page_size}
+            )
             if response.status_code == 404:
                 break
             j = response.json()
@@ -251,33 +1381,26 @@ class UnpacMeApi:
                 if 'description' in j.keys() and 'error' in j.keys():
                     raise UnpacMeApiException(j['error'], j['description'])
 
-            yield from (UnpacMeUpload(
-                result['id'],
-                UnpacMeStatus.from_string(result['status']),
-                datetime.datetime.utcfromtimestamp(result['created']),
-                Sha256(result['sha256'])
-            ) for result in j['results'])
-            cursor = j['cursor']
+            cursor = j.get('cursor')
+            yield [UnpacMeUpload.from_history_result(result) for result in j['results']], cursor
+            if not cursor or not j['results']:
+                break
 
     def search_hash(self, sha256: Sha256) -> typing.Iterator[FeedEntry]:
-        response = self.session.get(F'{self.BASE_URL}/private/search/hash/{sha256.hash}')
-        j = response.json()
-        if response.status_code == 404 and 'description' in j.keys():
-            raise HashNotFoundApiException(j['description'])
+        results = None if self.cache is None else self.cache.get_search(sha256)
+        if results is None:
+            response = self.session.get(F'{self.BASE_URL}/private/search/hash/{sha256.hash}')
+            j = response.json()
+            if response.status_code == 404 and 'description' in j.keys():
+                raise HashNotFoundApiException(j['description'])
+            results = j['results']
+            # An empty result list must not be cached, the file would be treated as known on the next run.
+            if self.cache is not None and results and all(
+                    UnpacMeStatus.from_string(result['status']).terminal for result in results
+            ):
+                self.cache.put_search(sha256, results)
 
-        for result in j['results']:
-            yield FeedEntry(
-                UnpacMeUpload(
-                    result['submission_id'],
-                    UnpacMeStatus.from_string(result['status']),
-                    datetime.datetime.utcfromtimestamp(result['created']),
-                    Sha256(result['sha256'])
-                ),
-                Sha256(result['sha256']),
-                [],
-                datetime.datetime.utcfromtimestamp(result['created']),
-                [Sha256(sha256) for sha256 in result['children']]
-            )
+        yield from (FeedEntry.from_search_result(result) for result in results)
 
     def get_quota(self) -> UnpacMeQuota:
         response = self.session.get(F'{self.BASE_URL}/private/user/access')
@@ -285,35 +1408,1046 @@ class UnpacMeApi:
         if response.status_code != 200 and 'error' in j.keys():
             raise ApiException(F'Api-Exception: {j}')
 
-        return UnpacMeQuota(
-            j['api_key'],
-            j['total_submissions'],
-            j['month_submissions'],
-            j['month_limit'],
-            j['roles'],
-        )
+        return UnpacMeQuota.from_json(j)
 
     def public_feed(self) -> typing.Iterator[FeedEntry]:
         response = self.session.get(F'{self.BASE_URL}/public/feed')
         if response.status_code != 200:
             raise ApiException(F'Api-Exception: {response.content}')
 
-        j = response.json()
+        yield from (FeedEntry.from_feed_result(result) for result in response.json()['results'])
+
+
+class AsyncUnpacMeApi:
+    BASE_URL = UnpacMeApi.BASE_URL
+
+    def __init__(self, api_key, user_agent, timeout: float = 5, connection_limit: int = 100):
+        if aiohttp is None:
+            raise ApiException('AsyncUnpacMeApi requires the package "aiohttp" to be installed')
+        self.headers = {
+            'User-Agent': user_agent,
+            'Authorization': F'Key {api_key}',
+        }
+        self.timeout = timeout
+        self.connection_limit = connection_limit
+        self._session = None
+
+    @property
+    def session(self) -> 'aiohttp.ClientSession':
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.connection_limit),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def upload(
+            self,
+            data: typing.Union[bytes, str, typing.BinaryIO],
+            sha256: typing.Optional[Sha256] = None
+    ) -> UnpacMeUpload:
+        if isinstance(data, str):
+            with open(data, 'rb') as fp:
+                return await self.upload(fp, sha256)
+        if sha256 is None and isinstance(data, bytes):
+            sha256 = Sha256.from_data(data)
+        elif sha256 is None:
+            position = data.tell()
+            sha256 = Sha256.from_file(data)
+            data.seek(position)
+
+        form = aiohttp.FormData()
+        form.add_field('file', data, filename='file', content_type='application/octet-stream')
+        async with self.session.post(F'{self.BASE_URL}/private/upload', data=form) as response:
+            if response.status != 200:
+                raise ApiException(F'Api-Exception: {await response.read()}')
+            j = await response.json()
+        return UnpacMeUpload(j['id'], UnpacMeStatus.UNKNOWN, datetime.datetime.now(), sha256)
+
+    async def status(self, upload: UnpacMeUpload) -> UnpacMeStatus:
+        async with self.session.get(F'{self.BASE_URL}/public/status/{upload.id}') as response:
+            if response.status != 200:
+                raise ApiException(F'Api-Exception: {await response.read()}')
+            return UnpacMeStatus.from_string((await response.json())['status'])
+
+    async def results(self, upload: UnpacMeUpload) -> UnpacMeResults:
+        async with self.session.get(F'{self.BASE_URL}/public/results/{upload.id}') as response:
+            if response.status != 200:
+                raise ApiException(F'Api-Exception: {await response.read()}')
+            return UnpacMeResults(await response.json())
+
+    async def download(self, sha256: Sha256) -> bytes:
+        async with self.session.get(F'{self.BASE_URL}/private/download/{sha256.hash}') as response:
+            if response.status != 200:
+                raise ApiException(F'Api-Exception: {await response.read()}')
+            return await response.read()
+
+    async def history(self, page_size: int = 10) -> typing.AsyncIterator[UnpacMeUpload]:
+        cursor = None
+        while True:
+            params = {'limit': page_size} if cursor is None else {'cursor': cursor, 'limit': page_size}
+            async with self.session.get(F'{self.BASE_URL}/private/history', params=params) as response:
+                if response.status == 404:
+                    break
+                j = await response.json()
+                if response.status == 400:
+                    if 'description' in j.keys() and 'error' in j.keys():
+                        raise UnpacMeApiException(j['error'], j['description'])
+
+            for result in j['results']:
+                yield UnpacMeUpload.from_history_result(result)
+            cursor = j.get('cursor')
+            if not cursor or not j['results']:
+                break
+
+    async def search_hash(self, sha256: Sha256) -> typing.AsyncIterator[FeedEntry]:
+        async with self.session.get(F'{self.BASE_URL}/private/search/hash/{sha256.hash}') as response:
+            j = await response.json()
+            if response.status == 404 and 'description' in j.keys():
+                raise HashNotFoundApiException(j['description'])
+
         for result in j['results']:
-            yield FeedEntry(
-                UnpacMeUpload(
-                    result['id'],
-                    UnpacMeStatus.from_string(result['status']),
-                    datetime.datetime.utcfromtimestamp(result['created']),
-                    result['sha256']
-                ),
-                Sha256(result['sha256']),
-                [malware['match'] for malware in result['malwareid']],
-                datetime.datetime.utcfromtimestamp(result['created']),
-                [Sha256(sha256) for sha256 in result['children']] if isinstance(result['children'], list) else [],
-                result['children']
+            yield FeedEntry.from_search_result(result)
+
+    async def get_quota(self) -> UnpacMeQuota:
+        async with self.session.get(F'{self.BASE_URL}/private/user/access') as response:
+            j = await response.json()
+            if response.status != 200 and 'error' in j.keys():
+                raise ApiException(F'Api-Exception: {j}')
+        return UnpacMeQuota.from_json(j)
+
+    async def public_feed(self) -> typing.AsyncIterator[FeedEntry]:
+        async with self.session.get(F'{self.BASE_URL}/public/feed') as response:
+            if response.status != 200:
+                raise ApiException(F'Api-Exception: {await response.read()}')
+            j = await response.json()
+
+        for result in j['results']:
+            yield FeedEntry.from_feed_result(result)
+
+
+class Deduplicator:
+    def __init__(self, api: UnpacMeApi, concurrency: int = 8, known_hashes: typing.Container[str] = ()):
+        self.api = api
+        self.concurrency = concurrency
+        self.known_hashes = known_hashes
+
+    def is_known(self, sha256: Sha256) -> bool:
+        if sha256.hash in self.known_hashes:
+            return True
+        try:
+            return any(True for _ in self.api.search_hash(sha256))
+        except HashNotFoundApiException:
+            return False
+
+    def run(self, file_names: typing.Iterable[str]) -> typing.Tuple[typing.List[UploadTask], typing.List[UploadTask]]:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as hash_executor:
+            hashes = {hash_executor.submit(Sha256.from_file, file_name): file_name for file_name in file_names}
+            return self.lookup(
+                UploadTask(hashes[future], future.result()) for future in concurrent.futures.as_completed(hashes)
             )
 
+    def lookup(self, tasks: typing.Iterable[UploadTask]) \
+            -> typing.Tuple[typing.List[UploadTask], typing.List[UploadTask]]:
+        new, known = [], []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as lookup_executor:
+            lookups = {lookup_executor.submit(self.is_known, task.sha256): task for task in tasks}
+            for future in concurrent.futures.as_completed(lookups):
+                (known if future.result() else new).append(lookups[future])
+        return new, known
+
+
+def hash_files(file_names: typing.List[str]) -> typing.List[bytes]:
+    return [Sha256.from_mapped_file(file_name).digest for file_name in file_names]
+
+
+class FileTriage:
+    def __init__(
+            self,
+            hash_cache: typing.Optional[HashCache] = None,
+            processes: typing.Optional[int] = None,
+            chunk_size: int = 16
+    ):
+        self.hash_cache = hash_cache
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.hashed = 0
+        self.cached = 0
+        self.logger = logging.getLogger('UnpacMeClient')
+
+    def expand(self, patterns: typing.Iterable[str]) -> typing.Iterator[typing.Tuple[str, os.stat_result]]:
+        for pattern in patterns:
+            for file_name in glob.iglob(pattern):
+                try:
+                    result = os.stat(file_name)
+                except FileNotFoundError:
+                    self.logger.error(F'Path "{file_name}" does not exist.')
+                    continue
+                if not stat.S_ISREG(result.st_mode):
+                    self.logger.error(F'Path "{file_name}" is not a file.')
+                    continue
+                yield file_name, result
+
+    def run(self, patterns: typing.Iterable[str]) -> typing.Tuple[typing.List[UploadTask], typing.List[UploadTask]]:
+        # Files are hashed in chunks on a process pool while the patterns are still being expanded, results are
+        # consumed in expansion order so the first of several files with the same content is the one kept.
+        chunks = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as executor:
+
+            def submit(files: typing.List[typing.Tuple[str, os.stat_result]]):
+                chunks.append((files, executor.submit(hash_files, [file_name for file_name, _ in files]), False))
+
+            pending = []
+            for file_name, result in self.expand(patterns):
+                self.logger.debug(F'Tasking "{file_name}"...')
+                sha256 = None if self.hash_cache is None else self.hash_cache.get(os.path.abspath(file_name), result)
+                if sha256 is None:
+                    pending.append((file_name, result))
+                    if len(pending) >= self.chunk_size:
+                        submit(pending)
+                        pending = []
+                else:
+                    # Files still waiting for a chunk come first, to keep the expansion order.
+                    if pending:
+                        submit(pending)
+                        pending = []
+                    self.cached += 1
+                    future = concurrent.futures.Future()
+                    future.set_result([sha256.digest])
+                    chunks.append(([(file_name, result)], future, True))
+            if pending:
+                submit(pending)
+
+            tasks, duplicates, computed, digests = [], [], [], set()
+            for files, future, cached in chunks:
+                if not cached:
+                    self.hashed += len(files)
+                for (file_name, result), digest in zip(files, future.result()):
+                    task = UploadTask(file_name, Sha256.from_digest(digest))
+                    if not cached:
+                        computed.append((os.path.abspath(file_name), result, task.sha256))
+                    if digest in digests:
+                        duplicates.append(task)
+                    else:
+                        digests.add(digest)
+                        tasks.append(task)
+        if self.hash_cache is not None:
+            self.hash_cache.put(computed)
+        return tasks, duplicates
+
+
+class PollState:
+    def __init__(self, upload: UnpacMeUpload, started: float):
+        self.upload = upload
+        self.started = started
+        self.finished = None
+        self.polls = 0
+        self.polls_in_status = 0
+
+    @property
+    def latency(self) -> typing.Optional[float]:
+        return None if self.finished is None else self.finished - self.started
+
+    def __repr__(self):
+        return F'<PollState {self.upload.id} {self.upload.status} polls={self.polls}>'
+
+
+class PollingStrategy:
+    # Relative poll interval per stage: waiting in the queue is slow, the stages close to completion are fast.
+    STAGE_FACTORS = {
+        UnpacMeStatus.UNKNOWN: 1.,
+        UnpacMeStatus.VALIDATING: 1.,
+        UnpacMeStatus.QUEUED: 3.,
+        UnpacMeStatus.ANALYZING: 2.,
+        UnpacMeStatus.UNPACK_PENDING: 2.,
+        UnpacMeStatus.UNPACKING: 1.5,
+        UnpacMeStatus.UNPACKED: .5,
+        UnpacMeStatus.POST_ANALYSIS: .5,
+    }
+    # Results are about to arrive in these stages, so their interval does not back off.
+    STEADY_STAGES = frozenset({UnpacMeStatus.UNPACKED, UnpacMeStatus.POST_ANALYSIS})
+
+    def __init__(
+            self,
+            base_interval: float = 20,
+            min_interval: float = 1,
+            max_interval: float = 120,
+            backoff: float = 1.5,
+            jitter: float = .1,
+            max_wait: typing.Optional[float] = None
+    ):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.max_wait = max_wait
+
+    def next_interval(self, state: PollState) -> float:
+        interval = self.base_interval * self.STAGE_FACTORS.get(state.upload.status, 1.)
+        if state.upload.status not in self.STEADY_STAGES:
+            interval *= self.backoff ** max(state.polls_in_status - 1, 0)
+        interval = max(self.min_interval, min(self.max_interval, interval))
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def timed_out(self, state: PollState, now: float) -> bool:
+        return self.max_wait is not None and now - state.started >= self.max_wait
+
+
+class SubmissionPoller:
+    WAKE_INTERVAL = 1.
+    UPLOAD_RETRY_INTERVAL = 60.
+    # Finished poll states are kept for inspection, a long-running watch only keeps the most recent ones.
+    COMPLETED_HISTORY = 1000
+
+    def __init__(
+            self,
+            api: UnpacMeApi,
+            strategy: PollingStrategy,
+            concurrency: int = 4,
+            on_update: typing.Optional[typing.Callable[[UploadTask, UnpacMeUpload], None]] = None
+    ):
+        self.api = api
+        self.strategy = strategy
+        self.concurrency = concurrency
+        self.on_update = on_update
+        self.stats = {}
+        self.completed = collections.deque(maxlen=self.COMPLETED_HISTORY)
+        self.logger = logging.getLogger('UnpacMeClient')
+
+    def upload_all(self, tasks: typing.Iterable[UploadTask]) \
+            -> typing.Iterator[typing.Tuple[UploadTask, UnpacMeUpload]]:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.api.upload, task.file_name, task.sha256): task for task in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                task = futures[future]
+                try:
+                    upload = future.result()
+                except requests.RequestException:
+                    raise
+                except OSError as e:
+                    self.logger.error(F'Uploading "{task.file_name}" failed, skipping it: {e}')
+                    continue
+                if self.on_update is not None:
+                    self.on_update(task, upload)
+                yield task, upload
+
+    def run(
+            self,
+            tasks: typing.Iterable[UploadTask],
+            uploaded: typing.Iterable[typing.Tuple[UploadTask, UnpacMeUpload]] = (),
+            incoming: typing.Optional[queue.Queue] = None
+    ) -> typing.Iterator[typing.Tuple[UploadTask, UnpacMeUpload, typing.Optional[UnpacMeResults]]]:
+        # With an incoming queue the poller keeps running and picks up new tasks until it receives None. Failing
+        # requests are then logged and retried later instead of ending the run. Deadlines without an upload are
+        # tasks waiting for another upload attempt. Uploads the API rejected are not retried but reported as failed
+        # without an upload ID.
+        tolerant = incoming is not None
+        sequence = itertools.count()
+        deadlines = []
+        for task, upload in uploaded:
+            self.stats[upload.id] = PollState(upload, time.monotonic())
+            heapq.heappush(deadlines, (time.monotonic(), next(sequence), task, upload))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = {executor.submit(self.api.upload, task.file_name, task.sha256): task for task in tasks}
+            while pending or deadlines or incoming is not None:
+                while incoming is not None:
+                    try:
+                        task = incoming.get_nowait()
+                    except queue.Empty:
+                        break
+                    if task is None:
+                        incoming = None
+                    else:
+                        pending[executor.submit(self.api.upload, task.file_name, task.sha256)] = task
+
+                done = [future for future in pending if future.done()]
+                for future in done:
+                    task = pending.pop(future)
+                    try:
+                        upload = future.result()
+                    except UploadRejectedApiException as e:
+                        if not tolerant:
+                            raise
+                        self.logger.error(F'Uploading "{task.file_name}" was rejected, giving up on it: {e}')
+                        yield task, UnpacMeUpload(None, UnpacMeStatus.FAIL, datetime.datetime.now(), task.sha256), None
+                        continue
+                    except (ApiException, requests.RequestException) as e:
+                        if not tolerant:
+                            raise
+                        self.logger.error(
+                            F'Uploading "{task.file_name}" failed, retrying in {self.UPLOAD_RETRY_INTERVAL:.0f}s: {e}'
+                        )
+                        heapq.heappush(
+                            deadlines, (time.monotonic() + self.UPLOAD_RETRY_INTERVAL, next(sequence), task, None)
+                        )
+                        continue
+                    except OSError as e:
+                        self.logger.error(F'Uploading "{task.file_name}" failed, skipping it: {e}')
+                        continue
+                    if self.on_update is not None:
+                        self.on_update(task, upload)
+                    self.stats[upload.id] = PollState(upload, time.monotonic())
+                    heapq.heappush(deadlines, (time.monotonic(), next(sequence), task, upload))
+
+                delay = deadlines[0][0] - time.monotonic() if deadlines else None
+                if incoming is not None:
+                    delay = self.WAKE_INTERVAL if delay is None else min(delay, self.WAKE_INTERVAL)
+                if delay is None or delay > 0:
+                    if pending:
+                        concurrent.futures.wait(pending, timeout=delay, return_when=concurrent.futures.FIRST_COMPLETED)
+                    elif delay is not None:
+                        time.sleep(delay)
+                    continue
+
+                _, _, task, upload = heapq.heappop(deadlines)
+                if upload is None:
+                    pending[executor.submit(self.api.upload, task.file_name, task.sha256)] = task
+                    continue
+                state = self.stats[upload.id]
+                self.logger.debug(F'polling status of submission id "{upload.id}"...')
+                try:
+                    status = self.api.status(upload)
+                except (ApiException, requests.RequestException) as e:
+                    if not tolerant:
+                        raise
+                    self.logger.warning(F'Polling submission "{upload.id}" failed: {e}')
+                    status = upload.status
+                state.polls += 1
+                changed = status != upload.status
+                state.polls_in_status = 1 if changed else state.polls_in_status + 1
+                upload.status = status
+                # Terminal states are reported together with their results by the caller.
+                if changed and not status.terminal and self.on_update is not None:
+                    self.on_update(task, upload)
+                now = time.monotonic()
+                if status.terminal:
+                    try:
+                        results = self.api.results(upload)
+                    except (ApiException, requests.RequestException) as e:
+                        if not tolerant:
+                            raise
+                        self.logger.warning(F'Fetching results of submission "{upload.id}" failed: {e}')
+                        heapq.heappush(
+                            deadlines, (now + self.strategy.next_interval(state), next(sequence), task, upload)
+                        )
+                        continue
+                    state.finished = now
+                    self.logger.debug(
+                        F'Submission "{upload.id}" reached {status} after {state.polls} polls in {state.latency:.1f}s'
+                    )
+                    self.completed.append(self.stats.pop(upload.id))
+                    yield task, upload, results
+                elif self.strategy.timed_out(state, now):
+                    self.logger.warning(
+                        F'Giving up on submission "{upload.id}" in {status} after {state.polls} polls'
+                    )
+                    self.completed.append(self.stats.pop(upload.id))
+                    yield task, upload, None
+                else:
+                    delay = self.strategy.next_interval(state)
+                    if self.strategy.max_wait is not None:
+                        delay = min(delay, max(state.started + self.strategy.max_wait - now, 0))
+                    heapq.heappush(deadlines, (now + delay, next(sequence), task, upload))
+
+
+class DownloadJob:
+    def __init__(self, sha256: Sha256, file_name: str):
+        self.sha256 = sha256
+        self.file_name = file_name
+
+    def __repr__(self):
+        return F'<DownloadJob {self.sha256.hash} {self.file_name}>'
+
+    @staticmethod
+    def from_results(results: UnpacMeResults, directory: str = '.') -> typing.List['DownloadJob']:
+        jobs = []
+        original_sha256 = results.sha256
+        for sample in results.iter_samples():
+            prefix = os.path.join(directory, F'{original_sha256.hash}.{sample.sha256.hash}')
+            if sample.autoit_sha256:
+                jobs.append(DownloadJob(sample.autoit_sha256, F'{prefix}._au3'))
+            if sample.sha256 != original_sha256:
+                jobs.append(DownloadJob(sample.sha256, F'{prefix}._exe'))
+        return jobs
+
+
+class DownloadPipeline:
+    def __init__(self, api: UnpacMeApi, concurrency: int = 4):
+        self.api = api
+        self.concurrency = concurrency
+        self.downloaded = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.elapsed = 0.
+        self.logger = logging.getLogger('UnpacMeClient')
+
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed else 0.
+
+    def _download(self, job: DownloadJob) -> typing.Optional[int]:
+        if os.path.exists(job.file_name):
+            self.logger.warning(F'Skipping "{job.file_name}" because file already exists')
+            return None
+        self.logger.debug(F'Downloading "{job.file_name}"...')
+        return self.api.download_to_file(job.sha256, job.file_name)
+
+    def run(self, jobs: typing.Iterable[DownloadJob]) \
+            -> typing.Iterator[typing.Tuple[DownloadJob, typing.Optional[int]]]:
+        start = time.monotonic()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = {executor.submit(self._download, job): job for job in jobs}
+                for future in concurrent.futures.as_completed(futures):
+                    size = future.result()
+                    if size is None:
+                        self.skipped += 1
+                    else:
+                        self.downloaded += 1
+                        self.bytes += size
+                    yield futures[future], size
+        finally:
+            self.elapsed += time.monotonic() - start
+
+    def summary(self) -> str:
+        return F'Downloaded {self.downloaded} file(s), {self.bytes / 1024 / 1024:.1f} MiB in {self.elapsed:.1f}s ' \
+               F'({self.throughput / 1024 / 1024:.1f} MiB/s), skipped {self.skipped} existing file(s)'
+
+
+class FeedFollower:
+    def __init__(
+            self,
+            api: UnpacMeApi,
+            interval: float = 60,
+            lookback: datetime.timedelta = datetime.timedelta(hours=1),
+            max_seen: int = 10000
+    ):
+        self.api = api
+        self.interval = interval
+        self.lookback = lookback
+        self.watermark = None
+        self.seen = collections.OrderedDict()
+        # Entries that did not match the predicate yet, e.g. because they are still running. They stay eligible even
+        # once they are older than the lookback, so slow submissions are still emitted when they complete.
+        self.unmatched = collections.OrderedDict()
+        self.max_seen = max_seen
+        self.logger = logging.getLogger('UnpacMeClient')
+
+    def _is_new(self, entry: FeedEntry) -> bool:
+        if entry.upload.id in self.seen:
+            return False
+        if entry.upload.id in self.unmatched:
+            return True
+        return self.watermark is None or entry.created >= self.watermark - self.lookback
+
+    def _mark_seen(self, entry: FeedEntry):
+        self.unmatched.pop(entry.upload.id, None)
+        self.seen[entry.upload.id] = None
+        while len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+
+    def _mark_unmatched(self, entry: FeedEntry):
+        self.unmatched[entry.upload.id] = None
+        while len(self.unmatched) > self.max_seen:
+            self.unmatched.popitem(last=False)
+
+    def poll(self, predicate: typing.Callable[[FeedEntry], bool] = lambda entry: True) -> typing.List[FeedEntry]:
+        entries = sorted(self.api.public_feed(), key=lambda entry: entry.created)
+        new_entries = []
+        for entry in entries:
+            # Entries which do not match yet, e.g. because they are not completed, are reconsidered on later polls.
+            if not self._is_new(entry):
+                continue
+            if predicate(entry):
+                self._mark_seen(entry)
+                new_entries.append(entry)
+            else:
+                self._mark_unmatched(entry)
+        if entries:
+            self.watermark = max(entries[-1].created, self.watermark or entries[-1].created)
+        return new_entries
+
+    def follow(
+            self,
+            predicate: typing.Callable[[FeedEntry], bool] = lambda entry: True,
+            max_polls: typing.Optional[int] = None
+    ) -> typing.Iterator[FeedEntry]:
+        for polls in itertools.count(1):
+            try:
+                yield from self.poll(predicate)
+            except (ApiException, requests.RequestException) as e:
+                self.logger.warning(F'Polling the feed failed, retrying in {self.interval}s: {e}')
+            if max_polls is not None and polls >= max_polls:
+                break
+            time.sleep(self.interval)
+
+
+class Inotify:
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, directory: str):
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, F'Cannot watch "{directory}"')
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self, timeout: float) -> typing.Tuple[typing.Set[str], bool]:
+        names, overflow = set(), False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return names, overflow
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            if mask & self.IN_Q_OVERFLOW:
+                overflow = True
+            elif length:
+                names.add(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+        return names, overflow
+
+
+class DirectoryWatcher:
+    def __init__(self, directory: str, settle: float = 2., scan_interval: float = 5., use_inotify: bool = True):
+        self.directory = directory
+        self.settle = settle
+        self.scan_interval = scan_interval
+        self.pending = {}
+        self.seen = {}
+        self.scanned = False
+        self.inotify = None
+        self.logger = logging.getLogger('UnpacMeClient')
+        if use_inotify:
+            try:
+                self.inotify = Inotify(directory)
+            except (ImportError, OSError, AttributeError, TypeError) as e:
+                self.logger.debug(F'inotify is not available, scanning "{directory}" every {scan_interval}s: {e}')
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def _scan(self) -> typing.Set[str]:
+        with os.scandir(self.directory) as entries:
+            paths = {entry.path for entry in entries}
+        # Forget deleted files, so a file reappearing under the same name is picked up again.
+        self.seen = {path: key for path, key in self.seen.items() if path in paths}
+        return paths
+
+    def _changed_paths(self) -> typing.Set[str]:
+        timeout = min(self.settle, self.scan_interval) if self.pending else self.scan_interval
+        if not self.scanned:
+            self.scanned = True
+            return self._scan()
+        if self.inotify is None:
+            time.sleep(timeout)
+            return self._scan()
+        names, overflow = self.inotify.read(timeout)
+        if overflow:
+            self.logger.warning(F'Missed file system events, rescanning "{self.directory}"')
+            return self._scan()
+        return {os.path.join(self.directory, name) for name in names}
+
+    @staticmethod
+    def _stat(path: str) -> typing.Optional[os.stat_result]:
+        try:
+            result = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return result if stat.S_ISREG(result.st_mode) else None
+
+    def poll(self) -> typing.List[str]:
+        for path in self._changed_paths():
+            if os.path.basename(path).startswith('.'):
+                continue
+            result = self._stat(path)
+            if result is not None and self.seen.get(path) != (result.st_size, result.st_mtime_ns):
+                self.pending[path] = (result.st_size, result.st_mtime_ns)
+
+        # A file is complete once it has neither grown nor been touched for the settle time.
+        ready = []
+        now = time.time()
+        for path, key in list(self.pending.items()):
+            result = self._stat(path)
+            if result is None:
+                del self.pending[path]
+                continue
+            current = (result.st_size, result.st_mtime_ns)
+            if current != key:
+                self.pending[path] = current
+            elif now - result.st_mtime >= self.settle:
+                del self.pending[path]
+                self.seen[path] = current
+                ready.append(path)
+        return ready
+
+    def batches(self, once: bool = False) -> typing.Iterator[typing.List[str]]:
+        while True:
+            # Empty batches are yielded as well, so the caller gets a chance to run periodic work.
+            yield self.poll()
+            if once and not self.pending:
+                return
+
+
+class WatchPipeline:
+    SCHEDULE_INTERVAL = 60.
+
+    def __init__(
+            self,
+            api: UnpacMeApi,
+            poller: SubmissionPoller,
+            manifest: JobManifest,
+            output_directory: str,
+            known_hashes: typing.Iterable[str] = (),
+            dedup_concurrency: int = 8,
+            download_concurrency: int = 4,
+            scheduler: typing.Optional[QuotaScheduler] = None
+    ):
+        self.api = api
+        self.poller = poller
+        self.manifest = manifest
+        self.scheduler = scheduler
+        self.queued = set()
+        self.scheduled = time.monotonic()
+        self.output_directory = output_directory
+        self.known_hashes = set(known_hashes) | manifest.hashes()
+        self.deduplicator = Deduplicator(api, dedup_concurrency, self.known_hashes)
+        self.downloads = DownloadPipeline(api, download_concurrency)
+        self.incoming = queue.Queue()
+        self.logger = logging.getLogger('UnpacMeClient')
+
+    def ingest(self, file_names: typing.List[str]):
+        tasks, known_tasks = self.deduplicator.run(file_names)
+        for task in known_tasks:
+            self.logger.info(F'Hash of "{task.file_name}" already exists, skipping.')
+        self.manifest.add_tasks(known_tasks, JobManifest.KNOWN)
+        new = []
+        for task in tasks:
+            # The same content may arrive under several names, only the first one is uploaded.
+            if task.sha256.hash in self.known_hashes:
+                self.manifest.add_tasks([task], JobManifest.KNOWN)
+                continue
+            self.known_hashes.add(task.sha256.hash)
+            self.manifest.add_tasks([task])
+            new.append(task)
+        self.submit(new)
+
+    def submit(self, tasks: typing.List[UploadTask] = ()):
+        # Without a scheduler every task is uploaded right away, otherwise tasks beyond the quota budget wait in the
+        # backlog until a later call has budget for them.
+        if self.scheduler is not None:
+            self.scheduled = time.monotonic()
+            scheduled = self.scheduler.schedule(tasks)
+            scheduled_file_names = {task.file_name for task in scheduled}
+            for task in tasks:
+                if os.path.abspath(task.file_name) not in scheduled_file_names:
+                    self.logger.info(F'Deferring "{task.file_name}" to stay within the quota.')
+                    self.manifest.set_status(task.file_name, JobManifest.DEFERRED)
+            tasks = [task for task in scheduled if task.file_name not in self.queued]
+        for task in tasks:
+            self.queued.add(os.path.abspath(task.file_name))
+            self.logger.info(F'Tasking "{task.file_name}"...')
+            self.incoming.put(task)
+
+    def _watch(self, watcher: DirectoryWatcher, once: bool):
+        retry = []
+        try:
+            for file_names in watcher.batches(once):
+                try:
+                    if retry or file_names:
+                        self.ingest(retry + file_names)
+                        retry = []
+                    elif self.scheduler is not None and time.monotonic() - self.scheduled >= self.SCHEDULE_INTERVAL:
+                        self.submit()
+                except (ApiException, requests.RequestException, OSError) as e:
+                    self.logger.error(F'Ingesting {len(file_names)} file(s) failed, retrying with the next batch: {e}')
+                    retry += file_names
+        finally:
+            self.incoming.put(None)
+
+    def store(self, results: UnpacMeResults):
+        directory = os.path.join(self.output_directory, results.sha256.hash)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'results.json'), 'w') as fp:
+            json.dump(results.raw_json, fp)
+        for _ in self.downloads.run(DownloadJob.from_results(results, directory)):
+            pass
+
+    def run(self, watcher: DirectoryWatcher, once: bool = False) \
+            -> typing.Iterator[typing.Tuple[UploadTask, UnpacMeUpload, typing.Optional[UnpacMeResults]]]:
+        os.makedirs(self.output_directory, exist_ok=True)
+        threading.Thread(target=self._watch, args=(watcher, once), daemon=True).start()
+        # Downloads run on their own thread, so slow transfers do not hold up polling of other submissions.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as store_executor:
+            finished = self.poller.run(self.manifest.pending_tasks(), self.manifest.running_uploads(), self.incoming)
+            for task, upload, results in finished:
+                self.queued.discard(os.path.abspath(task.file_name))
+                self.manifest.set_results(task, upload, results)
+                if upload.id is None and self.scheduler is not None:
+                    self.scheduler.backlog.remove(task)
+                if results is not None and upload.status == UnpacMeStatus.COMPLETE:
+                    store_executor.submit(self.store, results).add_done_callback(self._log_store_error)
+                yield task, upload, results
+
+    def _log_store_error(self, future: concurrent.futures.Future):
+        if future.exception() is not None:
+            self.logger.error(F'Storing results failed: {future.exception()}')
+
+
+class UnpackNode:
+    __slots__ = ('sha256', 'depth', 'submissions', 'children')
+
+    def __init__(self, sha256: Sha256, depth: int, submissions: typing.List[str], children: typing.List[Sha256]):
+        self.sha256 = sha256
+        self.depth = depth
+        self.submissions = submissions
+        self.children = children
+
+    def __repr__(self):
+        return F'<UnpackNode {self.sha256.hash} depth={self.depth} children={len(self.children)}>'
+
+    def to_json(self) -> typing.Dict:
+        return {
+            'sha256': self.sha256.hash,
+            'depth': self.depth,
+            'submissions': self.submissions,
+            'children': [child.hash for child in self.children],
+        }
+
+
+class UnpackTreeResolver:
+    def __init__(self, api: UnpacMeApi, concurrency: int = 8, max_depth: typing.Optional[int] = None):
+        self.api = api
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self.nodes = collections.OrderedDict()
+        self.lookups = 0
+        self.logger = logging.getLogger('UnpacMeClient')
+
+    def _lookup(self, sha256: Sha256, depth: int) -> UnpackNode:
+        self.logger.debug(F'Looking up children of "{sha256.hash}"...')
+        try:
+            entries = list(self.api.search_hash(sha256))
+        except HashNotFoundApiException:
+            entries = []
+        # Children of all submissions of the same file are merged, in order of first appearance.
+        children = collections.OrderedDict(
+            (child, None) for entry in entries for child in entry.children if child != sha256
+        )
+        return UnpackNode(sha256, depth, [entry.upload.id for entry in entries], list(children))
+
+    def resolve(self, roots: typing.Iterable[Sha256]) -> typing.Dict[Sha256, UnpackNode]:
+        # The graph is walked one level at a time, so a hash reachable from several parents is looked up once, at the
+        # depth of its shortest path, no matter which lookups happen to finish first.
+        claimed = set(self.nodes)
+        level = [root for root in collections.OrderedDict.fromkeys(roots) if root not in claimed]
+        depth = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while level:
+                claimed.update(level)
+                self.lookups += len(level)
+                next_level = collections.OrderedDict()
+                for node in executor.map(self._lookup, level, itertools.repeat(depth)):
+                    self.nodes[node.sha256] = node
+                    if self.max_depth is None or depth < self.max_depth:
+                        next_level.update((child, None) for child in node.children if child not in claimed)
+                level = list(next_level)
+                depth += 1
+        return self.nodes
+
+    def to_json(self, roots: typing.Iterable[Sha256]) -> typing.Dict:
+        return {
+            'roots': [root.hash for root in roots],
+            'nodes': [node.to_json() for node in sorted(self.nodes.values(), key=lambda node: node.depth)],
+        }
+
+    def to_dot(self, roots: typing.Iterable[Sha256]) -> str:
+        roots = set(roots)
+        lines = ['digraph unpacking {']
+        for node in sorted(self.nodes.values(), key=lambda node: node.depth):
+            attributes = [F'label="{node.sha256.hash[:16]}"']
+            if node.sha256 in roots:
+                attributes.append('shape=box')
+            if not node.submissions:
+                attributes.append('style=dashed')
+            lines.append(F'    "{node.sha256.hash}" [{", ".join(attributes)}];')
+            lines.extend(F'    "{node.sha256.hash}" -> "{child.hash}";' for child in node.children)
+        lines.append('}')
+        return '\n'.join(lines)
+
+
+class JsonLinesExportWriter:
+    def __init__(self, fp: typing.BinaryIO, compression_level: int = 6):
+        self.fp = gzip.GzipFile(fileobj=fp, mode='wb', compresslevel=compression_level)
+
+    def write(self, rows: typing.List[typing.Dict]):
+        for row in rows:
+            row = dict(row, created=row['created'].strftime('%Y-%m-%dT%H:%M:%SZ'))
+            self.fp.write(json.dumps(row, separators=(',', ':')).encode('utf-8') + b'\n')
+
+    def close(self):
+        self.fp.close()
+
+
+class ParquetExportWriter:
+    def __init__(self, fp: typing.BinaryIO, row_group_size: int = 64 * 1024):
+        if pyarrow is None:
+            raise ApiException('Exporting to Parquet requires the package "pyarrow" to be installed')
+        parquet = importlib.import_module('pyarrow.parquet')
+        self.schema = pyarrow.schema([
+            ('upload_id', pyarrow.string()),
+            ('created', pyarrow.timestamp('s', tz='UTC')),
+            ('status', pyarrow.string()),
+            ('parent_sha256', pyarrow.string()),
+            ('sha256', pyarrow.string()),
+            ('malware_names', pyarrow.list_(pyarrow.string())),
+            ('autoit_original_file_name', pyarrow.string()),
+            ('autoit_sha256', pyarrow.string()),
+        ])
+        self.writer = parquet.ParquetWriter(fp, self.schema, compression='zstd')
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def _flush(self):
+        if self.rows:
+            self.writer.write_table(pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def write(self, rows: typing.List[typing.Dict]):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.row_group_size:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+class ResultsExporter:
+    WRITERS = {
+        'jsonl': ('jsonl.gz', JsonLinesExportWriter),
+        'parquet': ('parquet', ParquetExportWriter),
+    }
+
+    def __init__(self, api: UnpacMeApi, directory: str, export_format: str = 'jsonl', concurrency: int = 8):
+        self.api = api
+        self.directory = directory
+        self.extension, self.writer_class = self.WRITERS[export_format]
+        self.concurrency = concurrency
+        self.exported = 0
+        self.rows = 0
+        self.pending = 0
+        self.failed = 0
+        self.logger = logging.getLogger('UnpacMeClient')
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, 'exported.sqlite'))
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS exported ('
+            'id TEXT PRIMARY KEY, file_name TEXT NOT NULL, exported_at REAL NOT NULL)'
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def rows_of(upload: UnpacMeUpload, results: UnpacMeResults) -> typing.List[typing.Dict]:
+        return [{
+            'upload_id': upload.id,
+            'created': upload.created.replace(tzinfo=datetime.timezone.utc),
+            'status': results.status.name.lower(),
+            'parent_sha256': results.sha256.hash,
+            'sha256': sample.sha256.hash,
+            'malware_names': sample.malware_names,
+            'autoit_original_file_name': sample.autoit_original_file_name,
+            'autoit_sha256': None if sample.autoit_sha256 is None else sample.autoit_sha256.hash,
+        } for sample in results.iter_samples()]
+
+    def _results(self, upload: UnpacMeUpload) -> typing.Optional[UnpacMeResults]:
+        try:
+            return self.api.results(upload)
+        except (ApiException, requests.RequestException) as e:
+            self.logger.warning(F'Fetching results of "{upload.id}" failed, retrying with the next export: {e}')
+            return None
+
+    def run(self, uploads: typing.Iterable[UnpacMeUpload]) -> typing.Optional[str]:
+        exported = {id for id, in self.connection.execute('SELECT id FROM exported')}
+        uploads = [upload for upload in uploads if upload.id not in exported]
+        if not uploads:
+            return None
+
+        # Every run writes a new part file, which only appears under its final name once it is complete. Uploads are
+        # recorded as exported together with the rename, so an interrupted run is simply repeated.
+        started = datetime.datetime.now(datetime.timezone.utc)
+        file_name = os.path.join(self.directory, F'samples-{started.strftime("%Y%m%dT%H%M%S%f")}.{self.extension}')
+        fd, temp_file_name = tempfile.mkstemp(prefix='.samples-', suffix='.part', dir=self.directory)
+        exported_ids = []
+        try:
+            with os.fdopen(fd, 'wb') as fp, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                writer = self.writer_class(fp)
+                futures = {executor.submit(self._results, upload): upload for upload in uploads}
+                for future in concurrent.futures.as_completed(futures):
+                    upload, results = futures[future], future.result()
+                    if results is None:
+                        self.failed += 1
+                    elif not results.status.terminal:
+                        self.pending += 1
+                    else:
+                        rows = self.rows_of(upload, results)
+                        writer.write(rows)
+                        self.rows += len(rows)
+                        exported_ids.append(upload.id)
+                writer.close()
+            if exported_ids:
+                os.replace(temp_file_name, file_name)
+            else:
+                os.unlink(temp_file_name)
+        except BaseException:
+            os.unlink(temp_file_name)
+            raise
+
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO exported (id, file_name, exported_at) VALUES (?, ?, ?)',
+            ((id, os.path.basename(file_name), now) for id in exported_ids)
+        )
+        self.connection.commit()
+        self.exported += len(exported_ids)
+        return file_name if exported_ids else None
+
+    def summary(self) -> str:
+        return F'Exported {self.exported} submission(s) with {self.rows} sample(s), {self.pending} not finished yet, ' \
+               F'{self.failed} failed'
+
 
 class ConsoleHandler(logging.Handler):
     def emit(self, record):
@@ -321,11 +2455,17 @@ class ConsoleHandler(logging.Handler):
 
 
 if __name__ == '__main__':
-    import platform
-    import time
-
     QUOTA_WARN_PERCENTAGE = .2
 
+    def status_argument(value: str) -> UnpacMeStatus:
+        status = UnpacMeStatus.from_string(value)
+        if status == UnpacMeStatus.UNKNOWN:
+            raise argparse.ArgumentTypeError(
+                F'unknown status "{value}", use one of: validating, queued, analyzing, unpack_pending, unpacking, '
+                F'unpacked, post_analysis, complete, fail'
+            )
+        return status
+
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest='command')
 
@@ -334,6 +2474,14 @@ if __name__ == '__main__':
     search_parser = subparsers.add_parser('search', help='Searches SHA256 hash.')
     search_parser.add_argument('sha256')
 
+    tree_parser = subparsers.add_parser(
+        'tree', help='Follow unpacked files across submissions and print the resulting graph.'
+    )
+    tree_parser.add_argument('sha256', nargs='*', help='Root SHA256 hashes, read from standard input if none are given')
+    tree_parser.add_argument('--format', choices=['json', 'dot'], default='json')
+    tree_parser.add_argument('--max-depth', type=int, help='Do not follow children deeper than this.')
+    tree_parser.add_argument('--concurrency', type=int, default=8, help='Number of hash lookups in parallel.')
+
     download_parser = subparsers.add_parser('download', help='Download file by SHA256 hash.')
     download_parser.add_argument('sha256')
     download_parser.add_argument('--file-name', help='Specify file name, will use SHA256 as file name if not specified')
@@ -347,8 +2495,36 @@ if __name__ == '__main__':
     feed_parser.add_argument('--completed-only', action='store_true', help='Only list those that are completed')
     feed_parser.add_argument('--malware-only', action='store_true', help='Only list those that have a malware assigned')
     feed_parser.add_argument('--sha256', action='store_true', help='Only print SHA256 hashes')
+    feed_parser.add_argument('--json', action='store_true', help='Print one JSON object per line')
+    feed_parser.add_argument(
+        '--follow', action='store_true',
+        help='Keep polling the feed and only print entries that were not printed before'
+    )
+    feed_parser.add_argument('--interval', type=float, default=60, help='Number of seconds between feed polls')
 
     history_parser = subparsers.add_parser('history', help='Request a list of your past submissions.')
+    history_parser.add_argument(
+        '--sync', action='store_true',
+        help='Fetch new submissions into the local history index and answer from the index.'
+    )
+    history_parser.add_argument(
+        '--local', action='store_true',
+        help='Answer from the local history index without any network access.'
+    )
+    history_parser.add_argument('--page-size', type=int, default=100, help='Number of submissions per request.')
+    history_parser.add_argument('--sha256', help='Only list submissions of this SHA256 hash (local index only).')
+    history_parser.add_argument(
+        '--since', type=datetime.datetime.fromisoformat,
+        help='Only list submissions created at or after this UTC date (local index only).'
+    )
+    history_parser.add_argument(
+        '--until', type=datetime.datetime.fromisoformat,
+        help='Only list submissions created before this UTC date (local index only).'
+    )
+    history_parser.add_argument(
+        '--status', type=status_argument,
+        help='Only list submissions in this status, e.g. "complete" (local index only).'
+    )
 
     status_parser = subparsers.add_parser('status', help='Check status for given upload ID.')
     status_parser.add_argument('upload_id', help='ID acquired by uploading a file')
@@ -358,185 +2534,532 @@ if __name__ == '__main__':
         help='Collect details of run in case job is completed.'
     )
     status_parser.add_argument('-u', '--download-unpacked-files', action='store_true')
+    status_parser.add_argument(
+        '--download-concurrency', type=int, default=4,
+        help='Number of unpacked files downloaded in parallel.'
+    )
+
+    download_results_parser = subparsers.add_parser(
+        'download-results',
+        help='Download unpacked files of several upload IDs, read from standard input if none are given.'
+    )
+    download_results_parser.add_argument('upload_ids', nargs='*', help='IDs acquired by uploading files')
+    download_results_parser.add_argument('-o', '--output-dir', default='.', help='Directory to store files in.')
+    download_results_parser.add_argument(
+        '--download-concurrency', type=int, default=4,
+        help='Number of files downloaded in parallel.'
+    )
 
     upload_parser = subparsers.add_parser('upload', help='Upload a PE file for unpacking and analysis.')
     upload_parser.add_argument('file_names', nargs='+', help='Files to be uploaded')
-    upload_parser.add_argument('-f', '--force', help='Force upload, even if hash already exists.')
+    upload_parser.add_argument(
+        '-f', '--force', action='store_true',
+        help='Force upload of all files, ignoring the remaining quota.'
+    )
+    upload_parser.add_argument(
+        '--priority', type=int, default=0,
+        help='Priority of these files in the backlog of submissions deferred because of the quota.'
+    )
     upload_parser.add_argument(
         '--print-id', action='store_true',
         help='Do not poll for results but print upload ID and terminate.'
     )
-    upload_parser.add_argument('--poll-interval', default=20, help='Number of seconds between polls.')
+    upload_parser.add_argument(
+        '--dedup-concurrency', type=int, default=8,
+        help='Number of hashes looked up in parallel before uploading.'
+    )
+    upload_parser.add_argument(
+        '--hash-processes', type=int,
+        help='Number of processes hashing files (default: number of CPUs).'
+    )
+    upload_parser.add_argument(
+        '--manifest',
+        help='Record progress of the batch in this job manifest so it can be continued with the resume command.'
+    )
+
+    resume_parser = subparsers.add_parser(
+        'resume', help='Continue an interrupted upload batch from its job manifest.'
+    )
+    resume_parser.add_argument('manifest', help='Job manifest written by upload --manifest')
+
+    backlog_parser = subparsers.add_parser(
+        'backlog', help='Submit files deferred because of the quota, as far as the quota allows.'
+    )
+    backlog_parser.add_argument('-l', '--list', action='store_true', help='Only list the deferred files.')
+
+    watch_parser = subparsers.add_parser(
+        'watch', help='Upload every file dropped into a directory and store results and unpacked files.'
+    )
+    watch_parser.add_argument('directory', help='Directory to watch for new files')
+    watch_parser.add_argument(
+        '-o', '--output-dir', default='unpac-me-results',
+        help='Directory receiving a results.json and the unpacked files per submitted SHA256.'
+    )
+    watch_parser.add_argument(
+        '--manifest',
+        help='Job manifest keeping track of submissions across restarts (default: manifest.sqlite in the output '
+             'directory).'
+    )
+    watch_parser.add_argument(
+        '--settle', type=float, default=2.,
+        help='Seconds a file has to stay unchanged before it is considered completely written.'
+    )
+    watch_parser.add_argument(
+        '--scan-interval', type=float, default=5.,
+        help='Seconds between directory scans if inotify is not available.'
+    )
+    watch_parser.add_argument('--no-inotify', action='store_true', help='Always scan the directory.')
+    watch_parser.add_argument(
+        '--once', action='store_true',
+        help='Process the files currently in the directory and exit once all of them are finished.'
+    )
+    watch_parser.add_argument(
+        '--dedup-concurrency', type=int, default=8,
+        help='Number of files hashed and looked up in parallel.'
+    )
+    watch_parser.add_argument(
+        '--download-concurrency', type=int, default=4,
+        help='Number of files downloaded in parallel.'
+    )
+
+    for scheduling_parser in (upload_parser, backlog_parser, watch_parser):
+        scheduling_parser.add_argument(
+            '--quota-share', type=float, default=QUOTA_WARN_PERCENTAGE,
+            help='Fraction of the remaining monthly quota a single run may use, the rest is deferred to the backlog.'
+        )
+        scheduling_parser.add_argument(
+            '--largest-first', action='store_true',
+            help='Submit larger files first among files of the same priority (default: smallest first).'
+        )
+
+    for polling_parser in (upload_parser, resume_parser, backlog_parser, watch_parser):
+        polling_parser.add_argument(
+            '--poll-interval', type=float, default=20,
+            help='Base number of seconds between polls, scaled by processing stage and backed off while the stage does '
+                 'not change.'
+        )
+        polling_parser.add_argument(
+            '--max-wait', type=float,
+            help='Stop polling a submission after this many seconds.'
+        )
+        polling_parser.add_argument(
+            '--concurrency', type=int, default=4,
+            help='Maximum number of uploads in flight at the same time.'
+        )
+
+    export_parser = subparsers.add_parser(
+        'export', help='Append the results of all finished submissions not exported yet to compact part files.'
+    )
+    export_parser.add_argument('-o', '--output-dir', default='unpac-me-export', help='Directory of the part files.')
+    export_parser.add_argument(
+        '--format', choices=sorted(ResultsExporter.WRITERS), default='jsonl',
+        help='Gzip compressed JSON Lines or, if pyarrow is installed, Parquet. One row per unpacked sample.'
+    )
+    export_parser.add_argument('--concurrency', type=int, default=8, help='Number of results fetched in parallel.')
+    export_parser.add_argument('--page-size', type=int, default=100, help='Page size used to sync the history.')
+
+    batch_parser = subparsers.add_parser(
+        'batch',
+        help='Run one command per line of standard input in this process, sharing its connections and cache.'
+    )
+    batch_parser.add_argument(
+        '--separator',
+        help='Line printed after every command, so a calling script knows when its output is complete.'
+    )
 
     parser.add_argument(
         '--api-key', default=os.getenv('UNPACME_API_KEY', None),
         help='Get your API key from https://www.unpac.me/account'
     )
     parser.add_argument('--debug', action='store_true')
-    parser.add_argument(
-        '--user-agent',
-        default=F'UnpacMeClient/{__version__} (python-requests {requests.__version__}) '
-                F'{platform.system()} ({platform.release()})'
-    )
+    parser.add_argument('--user-agent', help='Default: UnpacMeClient with the versions of requests and the OS.')
+    parser.add_argument('--base-url', default=UnpacMeApi.BASE_URL, help='API endpoint, e.g. of a local mock server.')
     parser.add_argument(
         '--ignore-quota', action='store_true',
         help='Client tries to regularly check your quota to print warnings accordingly. '
              'Pass this switch to disable this behavior'
     )
+    parser.add_argument('--timeout', type=float, default=5, help='Timeout in seconds for API requests.')
+    parser.add_argument('--upload-timeout', type=float, default=120, help='Timeout in seconds for uploads.')
+    parser.add_argument('--pool-size', type=int, default=10, help='Maximum number of connections kept per host.')
+    parser.add_argument('--retries', type=int, default=3, help='Number of retries for failed idempotent requests.')
+    parser.add_argument('--rate-limit', type=float, help='Maximum number of API requests per second.')
+    parser.add_argument('--stats', action='store_true', help='Print request statistics when the command finishes.')
+    parser.add_argument(
+        '--stats-format', choices=('text', 'prometheus'), default='text',
+        help='Format of the statistics printed by --stats.'
+    )
+    parser.add_argument(
+        '--cache-dir', default=ResultCache.default_directory(),
+        help='Directory of the local cache for completed results, hash searches and downloaded files.'
+    )
+    parser.add_argument('--no-cache', action='store_true', help='Do not read from or write to the local cache.')
+    parser.add_argument('--cache-max-size', type=int, default=1024, help='Maximum size of the cache in MiB.')
+    parser.add_argument('--cache-max-age', type=float, help='Maximum age of cache entries in days.')
     args = parser.parse_args()
 
     logger = logging.getLogger('UnpacMeClient')
     logger.handlers.append(ConsoleHandler())
     logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
 
-    logger.debug(F'Using User-Agent string: {args.user_agent}')
-    api = UnpacMeApi(args.api_key, args.user_agent)
-    try:
-        if args.command == 'upload':
-            tasks = []
-            for pattern in args.file_names:
-                for file_name in glob.glob(pattern):
-                    logger.debug(F'Tasking "{file_name}"...')
-                    if not os.path.exists(file_name):
-                        logger.error(F'Path "{file_name}" does not exist.')
-                        continue
-                    if not os.path.isfile(file_name):
-                        logger.error(F'Path "{file_name}" is not a file.')
-                        continue
-                    with open(file_name, 'rb') as fp:
-                        file_data = fp.read()
+    cache = None if args.no_cache else ResultCache(
+        args.cache_dir,
+        args.cache_max_size * 1024 * 1024,
+        None if args.cache_max_age is None else args.cache_max_age * 24 * 60 * 60
+    )
+    history_index_file_name = os.path.join(args.cache_dir, 'history.sqlite')
+    api = UnpacMeApi(
+        args.api_key,
+        args.user_agent,
+        cache,
+        timeout=args.timeout,
+        upload_timeout=args.upload_timeout,
+        pool_size=args.pool_size,
+        retries=args.retries,
+        rate_limit=args.rate_limit,
+        metrics=ApiMetrics() if args.stats else None
+    )
+    api.BASE_URL = args.base_url
 
-                    try:
-                        next(api.search_hash(Sha256.from_data(file_data)))
-                        logger.error(F'Hash of "{file_name}" already exists, skipping.')
-                        hash_already_uploaded = True
-                    except HashNotFoundApiException:
-                        hash_already_uploaded = False
-                    if hash_already_uploaded:
-                        continue
+    def execute(args: argparse.Namespace):
 
-                    tasks.append(file_data)
+        def make_scheduler() -> QuotaScheduler:
+            os.makedirs(args.cache_dir, exist_ok=True)
+            return QuotaScheduler(
+                QuotaTracker(api, os.path.join(args.cache_dir, 'quota.json')),
+                SubmissionBacklog(os.path.join(args.cache_dir, 'backlog.sqlite')),
+                args.quota_share,
+                args.largest_first
+            )
 
-            if not args.force:
-                quota = api.get_quota()
-                remaining = quota.month_limit - quota.month_submissions
-                percentage = float(len(tasks)) / float(remaining)
-                if percentage > QUOTA_WARN_PERCENTAGE:
-                    logger.error(
-                        F'This operation would use up {percentage:.0%} of your remaining quota, pass -f to execute it '
-                        F'anyway'
-                    )
-                    exit()
+        def make_poller(
+                manifest: typing.Optional[JobManifest],
+                scheduler: typing.Optional[QuotaScheduler] = None
+        ) -> SubmissionPoller:
+
+            def on_update(task: UploadTask, upload: UnpacMeUpload):
+                if manifest is not None:
+                    manifest.set_upload(task, upload)
+                if scheduler is not None:
+                    scheduler.submitted(task)
+
+            return SubmissionPoller(
+                api,
+                PollingStrategy(args.poll_interval, max_wait=args.max_wait),
+                args.concurrency,
+                on_update
+            )
+
+        def report_results(
+                finished: typing.Iterable[typing.Tuple[UploadTask, UnpacMeUpload, typing.Optional[UnpacMeResults]]],
+                manifest: typing.Optional[JobManifest]
+        ):
+            for task, upload, results in finished:
+                if manifest is not None:
+                    manifest.set_results(task, upload, results)
+                if upload.id is None:
+                    logger.error(F'Uploading "{task.file_name}" was rejected')
+                elif results is None:
+                    logger.error(F'Unpacking of "{task.file_name}" ({upload.id}) timed out in {upload.status}')
+                elif upload.status == UnpacMeStatus.FAIL:
+                    logger.error(F'Unpacking of "{task.file_name}" ({upload.id}) failed: {results}')
+                else:
+                    logger.info(F'Unpacking of "{task.file_name}" ({upload.id}) finished: {results}')
 
-            for file_data in tasks:
-                upload = api.upload(file_data)
+        try:
+            if args.command == 'upload':
+                triage = FileTriage(
+                    None if cache is None else HashCache(os.path.join(args.cache_dir, 'hashes.sqlite')),
+                    args.hash_processes
+                )
+                tasks, duplicate_tasks = triage.run(args.file_names)
+                logger.debug(F'Hashed {triage.hashed} file(s), {triage.cached} hash(es) taken from the cache.')
+                for task in duplicate_tasks:
+                    logger.warning(F'Content of "{task.file_name}" is part of this batch already, skipping.')
+
+                known_hashes = set() if cache is None else cache.known_hashes()
+                if os.path.exists(history_index_file_name):
+                    known_hashes |= HistoryIndex(history_index_file_name).hashes()
+                deduplicator = Deduplicator(api, args.dedup_concurrency, known_hashes)
+                tasks, known_tasks = deduplicator.lookup(tasks)
+                for task in known_tasks:
+                    logger.error(F'Hash of "{task.file_name}" already exists, skipping.')
+                logger.info(F'{len(tasks)} new file(s), {len(known_tasks)} already known file(s).')
+
+                manifest = None
+                if args.manifest is not None:
+                    manifest = JobManifest(args.manifest)
+                    manifest.add_tasks(known_tasks + duplicate_tasks, JobManifest.KNOWN)
+                    manifest.add_tasks(tasks)
+
+                scheduler = None
+                if not args.force and not args.ignore_quota:
+                    scheduler = make_scheduler()
+                    new_file_names = {task.file_name for task in tasks}
+                    tasks = scheduler.schedule(tasks, args.priority)
+                    deferred = len(scheduler.backlog) - len(tasks)
+                    if deferred:
+                        logger.warning(
+                            F'{deferred} file(s) remain in the backlog to stay within {args.quota_share:.0%} of your '
+                            F'remaining quota, they are submitted by later runs or the backlog command.'
+                        )
+                    if manifest is not None:
+                        scheduled = {task.file_name for task in tasks}
+                        for file_name in new_file_names - scheduled:
+                            manifest.set_status(file_name, JobManifest.DEFERRED)
+
+                poller = make_poller(manifest, scheduler)
                 if args.print_id:
-                    print(F'Your upload ID: {upload.id}')
-                    continue
+                    for task, upload in poller.upload_all(tasks):
+                        print(F'Your upload ID for "{task.file_name}": {upload.id}')
+                else:
+                    report_results(poller.run(tasks), manifest)
 
-                while True:
-                    logger.debug(F'polling status of submission id "{upload.id}"...')
-                    status = api.status(upload)
-                    if status == UnpacMeStatus.COMPLETE:
-                        break
-                    time.sleep(args.poll_interval)
-                logger.info(F'Unpacking finished: {api.results(upload)}')
-
-        elif args.command == 'quota':
-            quota = api.get_quota()
-            logger.debug(F'Quota: {quota}')
-            percentage = float(quota.month_submissions) / float(quota.month_limit)
-            print(
-                F'You already used {percentage:.0%} '
-                F'({quota.month_submissions} / {quota.month_limit}) of your quota this month.'
-            )
+            elif args.command == 'resume':
+                manifest = JobManifest(args.manifest)
+                tasks, uploaded = manifest.pending_tasks(), manifest.running_uploads()
+                logger.info(F'Resuming with {len(tasks)} file(s) to upload and {len(uploaded)} submission(s) to poll.')
+                report_results(make_poller(manifest).run(tasks, uploaded), manifest)
+                logger.info(F'Manifest status: {manifest.counts()}')
 
-        elif args.command == 'status':
-            upload = UnpacMeUpload(args.upload_id, UnpacMeStatus.UNKNOWN, datetime.datetime.now(), None)
-            status = api.status(upload)
-            if status == UnpacMeStatus.COMPLETE:
-                logger.info('Task completed')
-                results = api.results(upload) if (args.details or args.download_unpacked_files or args.list) else None
-                if args.details:
-                    print(json.dumps(results.raw_json, indent=4))
+            elif args.command == 'backlog':
+                scheduler = make_scheduler()
                 if args.list:
-                    print(F'SHA256: {results.sha256.hash}')
-                    print('')
-                    print('Unpacked Files')
-                    print('---')
-                    for sample in results.samples:
-                        line = F'{sample.sha256.hash}'
-                        if sample.malware_names:
-                            line += F' ({", ".join(sample.malware_names)})'
-                        if sample.autoit_sha256:
-                            line += F' [{sample.autoit_original_file_name}, {sample.autoit_sha256.hash}]'
-                        print(line)
-                if args.download_unpacked_files:
-
-                    def download_to_file(sha256: Sha256, file_name: str):
-                        if os.path.exists(file_name):
-                            logger.warning(F'Skipping "{file_name}" because file already exists')
-                            return
-                        logger.debug(F'Downloading "{file_name}"...')
-                        with open(file_name, 'wb') as fp:
-                            fp.write(api.download(sha256))
-
-
-                    original_sha256 = results.sha256
-                    for sample in results.samples:
-                        if sample.autoit_sha256:
-                            download_to_file(sample.autoit_sha256, F'{original_sha256.hash}.{sample.sha256.hash}._au3')
-                        if sample.sha256 != original_sha256:
-                            download_to_file(sample.sha256, F'{original_sha256.hash}.{sample.sha256.hash}._exe')
-            else:
-                logger.info('Task not completed')
-
-        elif args.command == 'history':
-            for upload in api.history():
+                    for task in scheduler.backlog.peek():
+                        print(F'{task.sha256.hash} {task.file_name}')
+                else:
+                    tasks = scheduler.schedule()
+                    logger.info(F'Submitting {len(tasks)} of {len(scheduler.backlog)} deferred file(s).')
+                    report_results(make_poller(None, scheduler).run(tasks), None)
+
+            elif args.command == 'watch':
+                os.makedirs(args.output_dir, exist_ok=True)
+                manifest = JobManifest(args.manifest or os.path.join(args.output_dir, 'manifest.sqlite'))
+                known_hashes = set() if cache is None else cache.known_hashes()
+                if os.path.exists(history_index_file_name):
+                    known_hashes |= HistoryIndex(history_index_file_name).hashes()
+                watcher = DirectoryWatcher(args.directory, args.settle, args.scan_interval, not args.no_inotify)
+                scheduler = None if args.ignore_quota else make_scheduler()
+                pipeline = WatchPipeline(
+                    api,
+                    make_poller(manifest, scheduler),
+                    manifest,
+                    args.output_dir,
+                    known_hashes,
+                    args.dedup_concurrency,
+                    args.download_concurrency,
+                    scheduler
+                )
+                logger.info(F'Watching "{args.directory}"...')
+                try:
+                    report_results(pipeline.run(watcher, args.once), None)
+                except KeyboardInterrupt:
+                    logger.info('Stopped watching, pass the same output directory to pick up where this run stopped.')
+                finally:
+                    watcher.close()
+                logger.info(F'Manifest status: {manifest.counts()}')
+                logger.info(pipeline.downloads.summary())
+
+            elif args.command == 'quota':
+                quota = api.get_quota()
+                logger.debug(F'Quota: {quota}')
+                percentage = float(quota.month_submissions) / float(quota.month_limit)
                 print(
-                    F'{upload.created.strftime("%Y-%m-%d %H:%M:%S")} '
-                    F'{upload.id} {upload.parent_sha256.hash} '
-                    F'({upload.status})'
+                    F'You already used {percentage:.0%} '
+                    F'({quota.month_submissions} / {quota.month_limit}) of your quota this month.'
                 )
 
-        elif args.command == 'download':
-            sha256 = Sha256(args.sha256.strip())
-            file_name = sha256.hash if args.file_name is None else args.file_name
-            if os.path.exists(file_name):
-                logger.warning(F'Skipping "{file_name}" because it already exists.')
-                exit()
-
-            logger.debug(F'Downloading "{file_name}"...')
-            with open(file_name, 'wb') as fp:
-                fp.write(api.download(sha256))
-
-        elif args.command == 'search':
-            sha256 = Sha256(args.sha256.strip())
-            for entry in api.search_hash(sha256):
-                print(F'SHA256: {entry.sha256.hash}')
-                print(F'Submission-ID: {entry.upload.id}')
-                print(F'Created at: {entry.created.strftime("%Y-%m-%d %H:%M:%S")}')
-                print('')
-                print('Unpacked Files')
-                for child in entry.children:
-                    print(child.hash)
-
-        elif args.command == 'feed':
-            for entry in api.public_feed():
-                if args.children_only and entry.children == 0:
-                    continue
-                if args.completed_only and entry.upload.status != UnpacMeStatus.COMPLETE:
-                    continue
-                if args.malware_only and len(entry.malware_tags) == 0:
-                    continue
+            elif args.command == 'status':
+                upload = UnpacMeUpload(args.upload_id, UnpacMeStatus.UNKNOWN, datetime.datetime.now(), None)
+                status = api.status(upload)
+                if status == UnpacMeStatus.COMPLETE:
+                    logger.info('Task completed')
+                    needs_results = args.details or args.download_unpacked_files or args.list
+                    results = api.results(upload) if needs_results else None
+                    if args.details:
+                        print(json.dumps(results.raw_json, indent=4))
+                    if args.list:
+                        print(F'SHA256: {results.sha256.hash}')
+                        print('')
+                        print('Unpacked Files')
+                        print('---')
+                        for sample in results.iter_samples():
+                            line = F'{sample.sha256.hash}'
+                            if sample.malware_names:
+                                line += F' ({", ".join(sample.malware_names)})'
+                            if sample.autoit_sha256:
+                                line += F' [{sample.autoit_original_file_name}, {sample.autoit_sha256.hash}]'
+                            print(line)
+                    if args.download_unpacked_files:
+                        pipeline = DownloadPipeline(api, args.download_concurrency)
+                        for _ in pipeline.run(DownloadJob.from_results(results)):
+                            pass
+                        logger.info(pipeline.summary())
+                else:
+                    logger.info('Task not completed')
 
-                if args.sha256:
-                    print(entry.sha256.hash)
+            elif args.command == 'download-results':
+                upload_ids = args.upload_ids or (line.strip() for line in sys.stdin if line.strip())
+                os.makedirs(args.output_dir, exist_ok=True)
+
+                def collect_jobs(upload_id: str) -> typing.List[DownloadJob]:
+                    upload = UnpacMeUpload(upload_id, UnpacMeStatus.UNKNOWN, datetime.datetime.now(), None)
+                    try:
+                        results = api.results(upload)
+                    except (ApiException, requests.RequestException) as e:
+                        logger.error(F'Skipping "{upload_id}" because fetching its results failed: {e}')
+                        return []
+                    if results.status != UnpacMeStatus.COMPLETE:
+                        logger.warning(F'Skipping "{upload_id}" because it is in {results.status}')
+                        return []
+                    return DownloadJob.from_results(results, args.output_dir)
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=args.download_concurrency) as executor:
+                    jobs = [job for jobs in executor.map(collect_jobs, upload_ids) for job in jobs]
+                pipeline = DownloadPipeline(api, args.download_concurrency)
+                for _ in pipeline.run(jobs):
+                    pass
+                logger.info(pipeline.summary())
+
+            elif args.command == 'history':
+                if args.sync or args.local:
+                    os.makedirs(args.cache_dir, exist_ok=True)
+                    history_index = HistoryIndex(history_index_file_name)
+                    if args.sync:
+                        logger.info(F'Synchronized {history_index.sync(api, args.page_size)} new submission(s).')
+                    uploads = history_index.query(
+                        None if args.sha256 is None else Sha256(args.sha256.strip()),
+                        args.since,
+                        args.until,
+                        args.status
+                    )
                 else:
+                    uploads = api.history(args.page_size)
+                for upload in uploads:
                     print(
-                        F'{entry.created.strftime("%Y-%m-%d %H:%M:%S")}: {entry.upload.id} '
-                        F'({entry.sha256.hash}) {", ".join(entry.malware_tags)}'
+                        F'{upload.created.strftime("%Y-%m-%d %H:%M:%S")} '
+                        F'{upload.id} {upload.parent_sha256.hash} '
+                        F'({upload.status})'
                     )
 
-    except ApiException as e:
-        logger.exception(e)
+            elif args.command == 'download':
+                sha256 = Sha256(args.sha256.strip())
+                file_name = sha256.hash if args.file_name is None else args.file_name
+                if os.path.exists(file_name):
+                    logger.warning(F'Skipping "{file_name}" because it already exists.')
+                else:
+                    logger.debug(F'Downloading "{file_name}"...')
+                    api.download_to_file(sha256, file_name)
+
+            elif args.command == 'search':
+                sha256 = Sha256(args.sha256.strip())
+                for entry in api.search_hash(sha256):
+                    print(F'SHA256: {entry.sha256.hash}')
+                    print(F'Submission-ID: {entry.upload.id}')
+                    print(F'Created at: {entry.created.strftime("%Y-%m-%d %H:%M:%S")}')
+                    print('')
+                    print('Unpacked Files')
+                    for child in entry.children:
+                        print(child.hash)
+
+            elif args.command == 'tree':
+                roots = [Sha256(sha256.strip()) for sha256 in (args.sha256 or sys.stdin) if sha256.strip()]
+                resolver = UnpackTreeResolver(api, args.concurrency, args.max_depth)
+                resolver.resolve(roots)
+                logger.debug(F'Resolved {len(resolver.nodes)} hash(es) with {resolver.lookups} lookup(s)')
+                if args.format == 'json':
+                    print(json.dumps(resolver.to_json(roots), indent=4))
+                else:
+                    print(resolver.to_dot(roots))
+
+            elif args.command == 'export':
+                os.makedirs(args.cache_dir, exist_ok=True)
+                history_index = HistoryIndex(history_index_file_name)
+                logger.info(F'Synchronized {history_index.sync(api, args.page_size)} new submission(s).')
+                exporter = ResultsExporter(api, args.output_dir, args.format, args.concurrency)
+                try:
+                    file_name = exporter.run(history_index.query())
+                finally:
+                    exporter.close()
+                if file_name is not None:
+                    logger.info(F'Wrote "{file_name}".')
+                logger.info(exporter.summary())
+
+            elif args.command == 'batch':
+                execute_batch(args)
+
+            elif args.command == 'feed':
+
+                def feed_filter(entry: FeedEntry) -> bool:
+                    if args.children_only and not entry.child_count:
+                        return False
+                    if args.completed_only and entry.upload.status != UnpacMeStatus.COMPLETE:
+                        return False
+                    if args.malware_only and len(entry.malware_tags) == 0:
+                        return False
+                    return True
+
+                if args.follow:
+                    entries = FeedFollower(api, args.interval).follow(feed_filter)
+                else:
+                    entries = filter(feed_filter, api.public_feed())
+                try:
+                    for entry in entries:
+                        if args.sha256:
+                            print(entry.sha256.hash, flush=args.follow)
+                        elif args.json:
+                            print(json.dumps(entry.to_json()), flush=args.follow)
+                        else:
+                            print(
+                                F'{entry.created.strftime("%Y-%m-%d %H:%M:%S")}: {entry.upload.id} '
+                                F'({entry.sha256.hash}) {", ".join(entry.malware_tags)}',
+                                flush=args.follow
+                            )
+                except KeyboardInterrupt:
+                    logger.info('Stopped following the feed.')
+
+        except ApiException as e:
+            logger.exception(e)
+
+    def execute_batch(args: argparse.Namespace):
+        # The API client, cache and logging are set up once from the global options of the batch, so lines must not
+        # set any of them. Pre-setting them to a marker tells which ones a line sets, as argparse keeps present values.
+        global_options = set(vars(parser.parse_args([]))) - {'command'}
+        unset = object()
+        for line in sys.stdin:
+            command = shlex.split(line, comments=True)
+            if not command:
+                continue
+            try:
+                command_args = parser.parse_args(command, argparse.Namespace(**dict.fromkeys(global_options, unset)))
+            except SystemExit:
+                command_args = None
+            overridden = [] if command_args is None else sorted(
+                option for option in global_options if getattr(command_args, option) is not unset
+            )
+            if command_args is None:
+                pass
+            elif command_args.command in (None, 'batch'):
+                logger.error(F'Expected a command other than batch: {line.strip()}')
+            elif overridden:
+                logger.error(
+                    F'Global options must be given before "batch", not per line: '
+                    F'{", ".join("--" + option.replace("_", "-") for option in overridden)}'
+                )
+            else:
+                for option in global_options:
+                    setattr(command_args, option, getattr(args, option))
+                try:
+                    execute(command_args)
+                except Exception as e:
+                    # A single failing command must not end the whole batch.
+                    logger.exception(e)
+            if args.separator is not None:
+                print(args.separator)
+            sys.stdout.flush()
+
+    try:
+        execute(args)
+    finally:
+        if api.metrics is not None:
+            print(api.metrics.summary() if args.stats_format == 'text' else api.metrics.prometheus(), file=sys.stderr)